@@ -1,101 +1,1254 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session, flash
-from datetime import datetime
+from flask import (Flask, render_template, request, redirect, url_for, session, flash, g, abort,
+                   stream_template, get_flashed_messages)
+from jinja2 import ChoiceLoader, DictLoader, ModuleLoader
+from markupsafe import Markup, escape
+from contextlib import contextmanager
+import atexit
+from datetime import datetime, timezone
 import sqlite3
+import gzip
 import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 # Используем переменную окружения для секретного ключа
 app.secret_key = os.environ.get('SECRET_KEY', 'edirt_secret_key_2024')
+# Количество постов на одной странице ленты
+FEED_PAGE_SIZE = int(os.environ.get('FEED_PAGE_SIZE', 20))
+# Количество пользователей на одной странице админки
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+# Сколько последних комментариев показывать у поста в ленте и сколько
+# подгружать за раз по ссылке "более ранние"
+FEED_COMMENTS_LIMIT = int(os.environ.get('FEED_COMMENTS_LIMIT', 3))
+COMMENTS_PAGE_SIZE = int(os.environ.get('COMMENTS_PAGE_SIZE', 20))
+# По сколько постов лента рендерится и отправляется в потоковом ответе
+FEED_STREAM_CHUNK = int(os.environ.get('FEED_STREAM_CHUNK', 5))
+# Максимальный размер страницы в JSON API
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 100))
+# Каталог для шаблонов, заранее скомпилированных в модули Python
+TEMPLATE_MODULES_DIR = os.environ.get('TEMPLATE_MODULES_DIR')
+
+# Пул соединений с БД: соединения переиспользуются между запросами,
+# чтобы не терять кэш страниц SQLite и кэш подготовленных выражений
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 8))
+SQLITE_STATEMENT_CACHE = int(os.environ.get('SQLITE_STATEMENT_CACHE', 256))
+
+# Используем /tmp для SQLite на Render (эта директория доступна для записи)
+DATABASE_PATH = os.environ.get('DATABASE_PATH', '/tmp/edirt.db')
+
+# Профиль настроек SQLite. WAL позволяет читателям ленты не ждать писателей,
+# а короткий busy_timeout переживает мгновенные блокировки. Дольше ждут
+# только циклы повторов с задержкой ниже, так что ожидание ограничено
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 50))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 128 * 1024 * 1024))
+# Отрицательное значение задает размер кэша в КиБ, а не в страницах
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -16000))
+SQLITE_TEMP_STORE = os.environ.get('SQLITE_TEMP_STORE', 'MEMORY')
+# Повторы захвата блокировки на запись (BEGIN IMMEDIATE). Худший случай
+# со значениями по умолчанию: 5 попыток по busy_timeout и задержки
+# 25+50+100+200 мс, около 0.6 с, после чего запрос получает 503
+SQLITE_WRITE_RETRIES = int(os.environ.get('SQLITE_WRITE_RETRIES', 4))
+SQLITE_WRITE_BACKOFF_MS = int(os.environ.get('SQLITE_WRITE_BACKOFF_MS', 25))
+# Повторы чтения страницы при блокировке (до 0.4 с вместе с busy_timeout)
+# и подсказка клиенту (Retry-After), когда БД так и не освободилась
+SQLITE_READ_RETRIES = int(os.environ.get('SQLITE_READ_RETRIES', 3))
+DB_RETRY_AFTER = int(os.environ.get('DB_RETRY_AFTER', 1))
+
+_db_pool = []
+_db_pool_lock = threading.Lock()
+_db_pool_pid = os.getpid()
 
 # Функции для работы с БД
-def get_db():
-    # Используем /tmp для SQLite на Render (эта директория доступна для записи)
-    db_path = '/tmp/edirt.db'
-    conn = sqlite3.connect(db_path)
+def connect_db():
+    # Соединение может переходить между потоками через пул,
+    # но одновременно им пользуется только один запрос
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False,
+                           timeout=SQLITE_BUSY_TIMEOUT / 1000,
+                           cached_statements=SQLITE_STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT:d}')
+    conn.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE:d}')
+    conn.execute(f'PRAGMA cache_size = {SQLITE_CACHE_SIZE:d}')
+    conn.execute(f'PRAGMA temp_store = {SQLITE_TEMP_STORE}')
     return conn
 
+def is_lock_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+@contextmanager
+def write_transaction():
+    # Транзакция на запись: блокировка берется сразу (BEGIN IMMEDIATE),
+    # а при занятой БД повторяем попытку с экспоненциальной задержкой
+    conn = get_db()
+    for attempt in range(SQLITE_WRITE_RETRIES + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as e:
+            if not is_lock_error(e) or attempt == SQLITE_WRITE_RETRIES:
+                raise
+            time.sleep(SQLITE_WRITE_BACKOFF_MS * (2 ** attempt) / 1000)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def _acquire_db():
+    global _db_pool_pid
+    with _db_pool_lock:
+        # После fork соединения родителя использовать нельзя
+        if _db_pool_pid != os.getpid():
+            _db_pool.clear()
+            _db_pool_pid = os.getpid()
+        if _db_pool:
+            return _db_pool.pop()
+    return connect_db()
+
+def _release_db(conn):
+    # Незавершенную транзакцию не отдаем следующему запросу
+    if conn.in_transaction:
+        conn.rollback()
+    with _db_pool_lock:
+        if _db_pool_pid == os.getpid() and len(_db_pool) < SQLITE_POOL_SIZE:
+            _db_pool.append(conn)
+            return
+    conn.close()
+
+def get_db():
+    # Одно соединение на контекст приложения, возвращается в пул при teardown
+    if 'db' not in g:
+        g.db = _acquire_db()
+    return g.db
+
+@app.teardown_appcontext
+def teardown_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        _release_db(conn)
+
+def close_db():
+    # Явно закрывает все простаивающие соединения пула
+    with _db_pool_lock:
+        connections = list(_db_pool)
+        _db_pool.clear()
+    for conn in connections:
+        conn.close()
+
+def describe_db_settings(conn):
+    settings = {}
+    for name in ('journal_mode', 'busy_timeout', 'synchronous', 'mmap_size',
+                 'cache_size', 'temp_store'):
+        settings[name] = conn.execute(f'PRAGMA {name}').fetchone()[0]
+    return settings
+
+# Миграции схемы БД. Номер последней примененной миграции хранится
+# в PRAGMA user_version; новые миграции добавляются только в конец списка
+MIGRATIONS = [
+    # 1: базовые таблицы
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            display_name TEXT,
+            password TEXT NOT NULL,
+            is_admin INTEGER DEFAULT 0,
+            is_banned INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            is_banned INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (post_id) REFERENCES posts (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS likes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (post_id) REFERENCES posts (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(post_id, user_id)
+        )
+        ''',
+    ),
+    # 2: индексы для ленты, комментариев и лайков
+    (
+        'CREATE INDEX IF NOT EXISTS idx_posts_created ON posts (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_posts_user_created ON posts (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_comments_post_created ON comments (post_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_likes_user_post ON likes (user_id, post_id)',
+    ),
+    # 3: денормализованные счетчики лайков и комментариев, которые
+    # поддерживаются триггерами в той же транзакции, что и запись
+    (
+        'ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_likes_insert AFTER INSERT ON likes BEGIN
+            UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_likes_delete AFTER DELETE ON likes BEGIN
+            UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_comments_insert AFTER INSERT ON comments BEGIN
+            UPDATE posts SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_comments_delete AFTER DELETE ON comments BEGIN
+            UPDATE posts SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+        END
+        ''',
+        'UPDATE posts SET like_count = (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id)',
+        'UPDATE posts SET comment_count = (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id)',
+    ),
+    # 4: глобальная версия данных для условных GET-запросов (ETag).
+    # Любое изменение пользователей, постов, комментариев или лайков увеличивает ее.
+    # Колонка updated_at и ее пересчет в триггерах убраны миграцией 12
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO data_version (id, version, updated_at) VALUES (1, 0, CAST(strftime('%s', 'now') AS INTEGER))",
+    ) + tuple(
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version AFTER {event} ON {table} BEGIN
+            UPDATE data_version SET version = version + 1,
+                                    updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE id = 1;
+        END
+        '''
+        for table in ('users', 'posts', 'comments', 'likes')
+        for event in ('INSERT', 'UPDATE', 'DELETE')
+    ),
+    # 5: индекс для постраничного списка пользователей
+    (
+        'CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, id)',
+    ),
+    # 6: журнал событий для живой ленты (/events). Его заполняют триггеры,
+    # поэтому события видны всем воркерам через общий файл БД.
+    # Триггер trg_events_prune оставляет в журнале последние 10000 записей
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_events_prune AFTER INSERT ON events BEGIN
+            DELETE FROM events WHERE id <= NEW.id - 10000;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_insert_event AFTER INSERT ON posts BEGIN
+            INSERT INTO events (type, data) 
+            VALUES ('post_created', json_object('post_id', NEW.id, 'user_id', NEW.user_id));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_comment_event AFTER UPDATE OF comment_count ON posts
+        WHEN NEW.comment_count > OLD.comment_count BEGIN
+            INSERT INTO events (type, data) 
+            VALUES ('comment_added', json_object('post_id', NEW.id, 'count', NEW.comment_count));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_like_event AFTER UPDATE OF like_count ON posts BEGIN
+            INSERT INTO events (type, data) 
+            VALUES ('like_count', json_object('post_id', NEW.id, 'count', NEW.like_count));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_ban_event AFTER UPDATE OF is_banned ON posts
+        WHEN NEW.is_banned = 1 AND OLD.is_banned = 0 BEGIN
+            INSERT INTO events (type, data) 
+            VALUES ('post_banned', json_object('post_id', NEW.id));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_ban_event AFTER UPDATE OF is_banned ON users
+        WHEN NEW.is_banned = 1 AND OLD.is_banned = 0 BEGIN
+            INSERT INTO events (type, data) 
+            VALUES ('user_banned', json_object('user_id', NEW.id));
+        END
+        ''',
+    ),
+    # 7: полнотекстовый поиск FTS5 по постам и комментариям. Индексы хранят
+    # только токены (external content), текст берется из исходных таблиц
+    tuple(
+        statement
+        for table in ('posts', 'comments')
+        for statement in (
+            f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                content, content='{table}', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+            ''',
+            f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+            ''',
+            f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            END
+            ''',
+            f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_update AFTER UPDATE OF content ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+                INSERT INTO {table}_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+            ''',
+            f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')",
+        )
+    ),
+    # 8: список пользователей в админке: счетчики постов и комментариев
+    # у пользователя, индекс для поиска по префиксу отображаемого имени
+    # (для username его дает UNIQUE) и частичные индексы под фильтры статуса
+    (
+        'ALTER TABLE users ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_user_count_insert AFTER INSERT ON posts BEGIN
+            UPDATE users SET post_count = post_count + 1 WHERE id = NEW.user_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_user_count_delete AFTER DELETE ON posts BEGIN
+            UPDATE users SET post_count = post_count - 1 WHERE id = OLD.user_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_comments_user_count_insert AFTER INSERT ON comments BEGIN
+            UPDATE users SET comment_count = comment_count + 1 WHERE id = NEW.user_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_comments_user_count_delete AFTER DELETE ON comments BEGIN
+            UPDATE users SET comment_count = comment_count - 1 WHERE id = OLD.user_id;
+        END
+        ''',
+        'UPDATE users SET post_count = (SELECT COUNT(*) FROM posts WHERE posts.user_id = users.id)',
+        'UPDATE users SET comment_count = (SELECT COUNT(*) FROM comments WHERE comments.user_id = users.id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_display_name ON users (display_name)',
+        'CREATE INDEX IF NOT EXISTS idx_users_banned ON users (created_at, id) WHERE is_banned = 1',
+        'CREATE INDEX IF NOT EXISTS idx_users_admins ON users (created_at, id) WHERE is_admin = 1',
+        'CREATE INDEX IF NOT EXISTS idx_users_active ON users (created_at, id) WHERE is_banned = 0 AND is_admin = 0',
+    ),
+    # 9: видимость поста хранится в самом посте (не забанен ни пост, ни
+    # автор) и поддерживается триггерами, так что лента читает один
+    # частичный индекс без JOIN-фильтра по users
+    (
+        'ALTER TABLE posts ADD COLUMN visible INTEGER NOT NULL DEFAULT 1',
+        '''
+        UPDATE posts SET visible = (
+            posts.is_banned = 0
+            AND NOT EXISTS (SELECT 1 FROM users WHERE users.id = posts.user_id AND users.is_banned = 1)
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_visible_insert AFTER INSERT ON posts
+        WHEN NEW.is_banned = 1
+          OR EXISTS (SELECT 1 FROM users WHERE id = NEW.user_id AND is_banned = 1) BEGIN
+            UPDATE posts SET visible = 0 WHERE id = NEW.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_posts_visible_ban AFTER UPDATE OF is_banned ON posts
+        WHEN NEW.is_banned IS NOT OLD.is_banned BEGIN
+            UPDATE posts SET visible = (
+                NEW.is_banned = 0
+                AND NOT EXISTS (SELECT 1 FROM users WHERE id = NEW.user_id AND is_banned = 1)
+            ) WHERE id = NEW.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_visible_ban AFTER UPDATE OF is_banned ON users
+        WHEN NEW.is_banned IS NOT OLD.is_banned BEGIN
+            UPDATE posts SET visible = (is_banned = 0 AND NEW.is_banned = 0)
+            WHERE user_id = NEW.id;
+        END
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_posts_visible ON posts (created_at, id) WHERE visible = 1',
+        # Лента больше не ходит по полному индексу, а писать в него дорого
+        'DROP INDEX IF EXISTS idx_posts_created',
+    ),
+    # 10: время в миллисекундах с эпохи (ts) для постов, комментариев и
+    # лайков. Упорядочивание по (ts, id) стабильно внутри одной секунды,
+    # а целые сравниваются дешевле строк. Существующие строки заполняются
+    # порциями в backfill_timestamps, а не в этой транзакции
+    (
+        'ALTER TABLE posts ADD COLUMN ts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE comments ADD COLUMN ts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE likes ADD COLUMN ts INTEGER NOT NULL DEFAULT 0',
+        'DROP INDEX IF EXISTS idx_posts_visible',
+        'CREATE INDEX IF NOT EXISTS idx_posts_visible_ts ON posts (ts, id) WHERE visible = 1',
+        'DROP INDEX IF EXISTS idx_posts_user_created',
+        'CREATE INDEX IF NOT EXISTS idx_posts_user_ts ON posts (user_id, ts)',
+        'DROP INDEX IF EXISTS idx_comments_post_created',
+        'CREATE INDEX IF NOT EXISTS idx_comments_post_ts ON comments (post_id, ts, id)',
+    ),
+    # 11: отметки о завершенных фоновых заполнениях данных, чтобы при
+    # каждом запуске не проверять их заново по всем строкам
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS backfills (
+            name TEXT PRIMARY KEY,
+            finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 12: Last-Modified больше не отдаем, поэтому время изменения данных
+    # не нужно: триггеры версии только увеличивают счетчик
+    tuple(
+        f'DROP TRIGGER IF EXISTS trg_{table}_{event.lower()}_version'
+        for table in ('users', 'posts', 'comments', 'likes')
+        for event in ('INSERT', 'UPDATE', 'DELETE')
+    ) + (
+        'ALTER TABLE data_version DROP COLUMN updated_at',
+    ) + tuple(
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version AFTER {event} ON {table} BEGIN
+            UPDATE data_version SET version = version + 1 WHERE id = 1;
+        END
+        '''
+        for table in ('users', 'posts', 'comments', 'likes')
+        for event in ('INSERT', 'UPDATE', 'DELETE')
+    ),
+]
+# Таблицы с колонкой ts, которую backfill_timestamps заполняет из created_at
+TIMESTAMP_TABLES = ('posts', 'comments', 'likes')
+TIMESTAMP_BACKFILL_BATCH = int(os.environ.get('TIMESTAMP_BACKFILL_BATCH', 1000))
+SCHEMA_VERSION = len(MIGRATIONS)
+SEARCH_TABLES = ('posts_fts', 'comments_fts')
+
+def migrate_db():
+    conn = get_db()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return version
+    
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        with write_transaction() as conn:
+            # Другой воркер мог применить миграцию, пока мы ждали блокировку
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= number:
+                continue
+            print(f"Applying migration {number}...")
+            for statement in MIGRATIONS[number - 1]:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number:d}')
+    return SCHEMA_VERSION
+
+def repair_counts():
+    # Пересчитывает денормализованные счетчики одним проходом по таблицам
+    with write_transaction() as conn:
+        posts_fixed = conn.execute('''
+            UPDATE posts SET 
+                like_count = counts.likes,
+                comment_count = counts.comments
+            FROM (
+                SELECT posts.id AS post_id,
+                       (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id) AS likes,
+                       (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id) AS comments
+                FROM posts
+            ) AS counts
+            WHERE posts.id = counts.post_id
+              AND (posts.like_count != counts.likes OR posts.comment_count != counts.comments)
+        ''').rowcount
+        users_fixed = conn.execute('''
+            UPDATE users SET 
+                post_count = counts.posts,
+                comment_count = counts.comments
+            FROM (
+                SELECT users.id AS user_id,
+                       (SELECT COUNT(*) FROM posts WHERE posts.user_id = users.id) AS posts,
+                       (SELECT COUNT(*) FROM comments WHERE comments.user_id = users.id) AS comments
+                FROM users
+            ) AS counts
+            WHERE users.id = counts.user_id
+              AND (users.post_count != counts.posts OR users.comment_count != counts.comments)
+        ''').rowcount
+    return posts_fixed, users_fixed
+
+@app.cli.command('repair-counts')
+def repair_counts_command():
+    """Пересчитать денормализованные счетчики постов и пользователей."""
+    posts_fixed, users_fixed = repair_counts()
+    print(f"Repaired counters on {posts_fixed} posts and {users_fixed} users")
+
+def rebuild_search_index():
+    # Перестраивает полнотекстовые индексы по текущему содержимому таблиц
+    with write_transaction() as conn:
+        for table in SEARCH_TABLES:
+            conn.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+            conn.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+
+def backfill_timestamps(batch_size=TIMESTAMP_BACKFILL_BATCH, force=False):
+    # Заполняет ts у строк, созданных до миграции 10. Идем по диапазонам id
+    # короткими транзакциями, чтобы не держать блокировку записи надолго.
+    # Законченный проход отмечается в backfills и больше не повторяется
+    conn = get_db()
+    if not force and conn.execute("SELECT 1 FROM backfills WHERE name = 'timestamps'").fetchone():
+        return 0
+    filled = 0
+    for table in TIMESTAMP_TABLES:
+        last_id = conn.execute(f'SELECT MAX(id) FROM {table}').fetchone()[0] or 0
+        for start in range(0, last_id, batch_size):
+            with write_transaction() as conn:
+                filled += conn.execute(f'''
+                    UPDATE {table} 
+                    SET ts = COALESCE(CAST(strftime('%s', created_at) AS INTEGER) * 1000, 0)
+                    WHERE id > ? AND id <= ? AND ts = 0
+                ''', (start, start + batch_size)).rowcount
+    with write_transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO backfills (name) VALUES ('timestamps')")
+    return filled
+
+@app.cli.command('backfill-timestamps')
+def backfill_timestamps_command():
+    """Заполнить ts у постов, комментариев и лайков, созданных до миграции."""
+    print(f"Filled timestamps on {backfill_timestamps(force=True)} rows")
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Перестроить полнотекстовый индекс постов и комментариев."""
+    rebuild_search_index()
+    print("Search index rebuilt")
+
 def init_db():
     print("Initializing database...")
-    with get_db() as conn:
-        # Создаем таблицу пользователей
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                display_name TEXT,
-                password TEXT NOT NULL,
-                is_admin INTEGER DEFAULT 0,
-                is_banned INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица постов
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                is_banned INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Таблица комментариев
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (post_id) REFERENCES posts (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Таблица лайков
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS likes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (post_id) REFERENCES posts (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(post_id, user_id)
-            )
-        ''')
+    with app.app_context():
+        conn = get_db()
+        # Режим журнала хранится в самом файле БД, достаточно задать его один раз
+        conn.execute(f'PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}')
+        settings = describe_db_settings(conn)
+        print(f"SQLite {DATABASE_PATH}: " + ', '.join(f'{k}={v}' for k, v in settings.items()))
+        
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            print(f"Database schema is up to date (version {version})")
+        else:
+            migrate_db()
+        filled = backfill_timestamps()
+        if filled:
+            print(f"Filled timestamps on {filled} rows")
         
         # Проверяем, есть ли админ
-        admin = conn.execute('SELECT * FROM users WHERE username = ?', ('admin',)).fetchone()
+        admin = conn.execute('SELECT id FROM users WHERE username = ?', ('admin',)).fetchone()
         if not admin:
             print("Creating admin user...")
             admin_password = hash_password('fima1456Game!')
-            conn.execute('''
-                INSERT INTO users (username, display_name, password, is_admin) 
-                VALUES (?, ?, ?, ?)
-            ''', ('admin', 'Официальный Аккаунт Edirt', admin_password, 1))
+            with write_transaction() as conn:
+                conn.execute('''
+                    INSERT INTO users (username, display_name, password, is_admin) 
+                    VALUES (?, ?, ?, ?)
+                ''', ('admin', 'Официальный Аккаунт Edirt', admin_password, 1))
         
         # Создаем тестовый пост для проверки
-        test_post = conn.execute('SELECT * FROM posts').fetchone()
+        test_post = conn.execute('SELECT id FROM posts LIMIT 1').fetchone()
         if not test_post:
             print("Creating test post...")
-            # Получаем ID админа
-            admin_id = conn.execute('SELECT id FROM users WHERE username = ?', ('admin',)).fetchone()['id']
-            conn.execute('''
-                INSERT INTO posts (user_id, content) VALUES (?, ?)
-            ''', (admin_id, 'Добро пожаловать в Edirt! 🎉 Это тестовый пост от официального аккаунта.'))
+            with write_transaction() as conn:
+                # Получаем ID админа
+                admin_id = conn.execute('SELECT id FROM users WHERE username = ?', ('admin',)).fetchone()['id']
+                conn.execute('''
+                    INSERT INTO posts (user_id, content, ts) VALUES (?, ?, ?)
+                ''', (admin_id, 'Добро пожаловать в Edirt! 🎉 Это тестовый пост от официального аккаунта.',
+                      now_ms()))
         
-        conn.commit()
         print("Database initialized successfully!")
 
+@app.cli.command('init-db')
+def init_db_command():
+    """Создать или обновить схему БД и начальные данные."""
+    init_db()
+
+# Счетчики ошибок БД по классам, отдаются в /admin/metrics
+db_error_counts = {'schema_missing': 0, 'lock_retries': 0, 'overloaded': 0, 'other': 0}
+_db_error_lock = threading.Lock()
+_schema_lock = threading.Lock()
+
+def count_db_error(kind):
+    with _db_error_lock:
+        db_error_counts[kind] += 1
+
+def is_schema_error(error):
+    message = str(error).lower()
+    return 'no such table' in message or 'no such column' in message
+
+def with_db_retries(func, *args):
+    # Выполняет чтение, повторяя его при временной блокировке БД с
+    # экспоненциальной задержкой. Если схемы нет (например, файл БД
+    # удалили), один раз запускает init_db и повторяет запрос
+    schema_restored = False
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if is_schema_error(e) and not schema_restored:
+                count_db_error('schema_missing')
+                schema_restored = True
+                # Схему восстанавливает один поток, миграции идемпотентны
+                with _schema_lock:
+                    init_db()
+                continue
+            # Остальные ошибки и исчерпанные повторы уходят в handle_db_error
+            if not is_lock_error(e) or attempt == SQLITE_READ_RETRIES:
+                raise
+            count_db_error('lock_retries')
+            time.sleep(SQLITE_WRITE_BACKOFF_MS * (2 ** attempt) / 1000)
+            attempt += 1
+
+@app.errorhandler(sqlite3.Error)
+def handle_db_error(error):
+    # Занятая БД - временная перегрузка: отвечаем 503 и просим повторить
+    # позже, вместо того чтобы отдавать 500 или перенаправлять по кругу
+    if isinstance(error, sqlite3.OperationalError) and is_lock_error(error):
+        count_db_error('overloaded')
+        print(f"Database is busy on {request.path}: {error}")
+        if request.path.startswith('/api/'):
+            response = json_response({'error': 'Сервис перегружен, попробуйте позже'}, 503)
+        else:
+            response = app.response_class('Сервис перегружен, попробуйте позже', status=503,
+                                          mimetype='text/plain')
+        response.headers['Retry-After'] = str(DB_RETRY_AFTER)
+        return response
+    count_db_error('other')
+    raise error
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+def now_ms():
+    return int(time.time() * 1000)
+
+@app.template_filter('datetime')
+def format_ts(ts):
+    # Время хранится в миллисекундах UTC, в том же виде, что и created_at
+    if not ts:
+        return ''
+    return datetime.fromtimestamp(ts / 1000, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+# Неотрицательное целое из запроса, которое поместится в INTEGER SQLite.
+# isdigit() пропускает символы вроде "²", которые int() не разбирает
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+
+def parse_int(value):
+    if not isinstance(value, str) or not value.isdecimal():
+        return None
+    number = int(value)
+    return number if number <= SQLITE_MAX_INTEGER else None
+
+# Курсоры имеют вид "<ключ сортировки>,<id>" последней показанной строки
+def parse_cursor(value):
+    if not value:
+        return None
+    key, sep, row_id = value.rpartition(',')
+    row_id = parse_int(row_id)
+    if not sep or not key or row_id is None:
+        return None
+    return key, row_id
+
+# В ленте и комментариях ключ - ts, целое число миллисекунд
+def parse_feed_cursor(value):
+    cursor = parse_cursor(value)
+    if cursor is None:
+        return None
+    ts = parse_int(cursor[0])
+    if ts is None:
+        return None
+    return ts, cursor[1]
+
+def make_feed_cursor(row):
+    return f"{row['ts']},{row['id']}"
+
+def make_users_cursor(user):
+    return f"{user['created_at']},{user['id']}"
+
+# Одна страница видимых постов (см. миграцию 9), от новых к старым.
+# Берем на один пост больше, чтобы понять, есть ли следующая страница
+def fetch_feed_page(conn, cursor, limit):
+    if cursor:
+        posts = conn.execute('''
+            SELECT posts.*, users.username, users.display_name, users.is_admin 
+            FROM posts 
+            JOIN users ON posts.user_id = users.id 
+            WHERE posts.visible = 1
+              AND (posts.ts, posts.id) < (?, ?)
+            ORDER BY posts.ts DESC, posts.id DESC
+            LIMIT ?
+        ''', (cursor[0], cursor[1], limit + 1)).fetchall()
+    else:
+        posts = conn.execute('''
+            SELECT posts.*, users.username, users.display_name, users.is_admin 
+            FROM posts 
+            JOIN users ON posts.user_id = users.id 
+            WHERE posts.visible = 1
+            ORDER BY posts.ts DESC, posts.id DESC
+            LIMIT ?
+        ''', (limit + 1,)).fetchall()
+    
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = make_feed_cursor(posts[-1])
+    return posts, next_cursor
+
+# Фильтры списка пользователей. Условия совпадают с условиями частичных
+# индексов, иначе SQLite не сможет ими воспользоваться
+USER_STATUS_FILTERS = {
+    'all': None,
+    'banned': 'is_banned = 1',
+    'admin': 'is_admin = 1',
+    'active': 'is_banned = 0 AND is_admin = 0',
+}
+
+def prefix_bounds(prefix):
+    # Диапазон [prefix, prefix + максимальный символ) - поиск по префиксу,
+    # который обслуживается обычным индексом, в отличие от LIKE
+    return prefix, prefix + '\U0010ffff'
+
+# Одна страница пользователей, от новых к старым
+def fetch_users_page(conn, status, prefix, cursor, limit):
+    conditions = []
+    params = []
+    if USER_STATUS_FILTERS.get(status):
+        conditions.append(USER_STATUS_FILTERS[status])
+    if prefix:
+        low, high = prefix_bounds(prefix)
+        conditions.append('''id IN (
+            SELECT id FROM users WHERE username >= ? AND username < ?
+            UNION
+            SELECT id FROM users WHERE display_name >= ? AND display_name < ?
+        )''')
+        params += [low, high, low, high]
+    if cursor:
+        conditions.append('(created_at, id) < (?, ?)')
+        params += [cursor[0], cursor[1]]
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    users = conn.execute(f'''
+        SELECT * FROM users 
+        {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+    
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = make_users_cursor(users[-1])
+    return users, next_cursor
+
+# Кэш с вытеснением давно неиспользуемых записей (LRU) и временем жизни записи
+class LRUCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+    
+    def delete_where(self, predicate):
+        with self._lock:
+            keys = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+    
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+# Кэш отрендеренных фрагментов постов: ключ - id поста, значение хранит
+# версию поста, поэтому изменения из других воркеров тоже не дают устаревший HTML
+post_fragment_cache = LRUCache(
+    int(os.environ.get('FRAGMENT_CACHE_SIZE', 2000)),
+    int(os.environ.get('FRAGMENT_CACHE_TTL', 300)),
+)
+
+def post_version(post):
+    return post['comment_count']
+
+# Валидаторы для условных GET-запросов. ETag учитывает версию данных,
+# зрителя, версию шаблонов и стилей, поэтому ответ 304 отдается до любых
+# запросов к постам и до рендеринга. Last-Modified не отдаем: дата с
+# точностью до секунды не учитывает ни зрителя, ни записи в ту же секунду
+def get_data_version(conn):
+    return conn.execute('SELECT version FROM data_version WHERE id = 1').fetchone()[0]
+
+def page_validators(conn, *key):
+    # Flash-сообщения показываются один раз, такие ответы не кэшируем
+    if '_flashes' in session:
+        return None
+    version = get_data_version(conn)
+    viewer = (session.get('user_id'), session.get('is_admin'),
+              session.get('user_banned'), session.get('display_name'))
+    assets = [asset['etag'] for asset in _assets.values()]
+    digest = hashlib.sha1(repr((TEMPLATES_DIGEST, assets, version, viewer, key)).encode())
+    return {'etag': digest.hexdigest()[:24]}
+
+def is_not_modified(validators):
+    if validators is None:
+        return False
+    return request.if_none_match.contains_weak(validators['etag'])
+
+def with_validators(response, validators):
+    response = app.make_response(response)
+    if validators is not None:
+        # Слабый ETag остается верным и для сжатых вариантов ответа
+        response.set_etag(validators['etag'], weak=True)
+        # Страница зависит от зрителя: общим кэшам ее хранить нельзя,
+        # а браузер должен каждый раз перепроверять ее
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def not_modified(validators):
+    return with_validators(app.response_class(status=304), validators)
+
+# Кэш целых страниц ленты для анонимных посетителей: всем им отдается
+# одинаковый HTML. Время жизни короткое, так как другие воркеры
+# не могут сбросить кэш этого процесса
+page_cache = LRUCache(
+    int(os.environ.get('PAGE_CACHE_SIZE', 64)),
+    int(os.environ.get('PAGE_CACHE_TTL', 5)),
+)
+
+def can_use_page_cache():
+    # Flask хранит flash-сообщения в сессии до их показа
+    return 'user_id' not in session and '_flashes' not in session
+
+def invalidate_page_cache():
+    page_cache.clear()
+
+def invalidate_post(post_id):
+    post_fragment_cache.delete(post_id)
+
+def invalidate_user_posts(*user_ids):
+    user_ids = set(user_ids)
+    post_fragment_cache.delete_where(lambda post_id, entry: entry['user_id'] in user_ids)
+
+def invalidate_posts(post_ids):
+    post_ids = set(post_ids)
+    post_fragment_cache.delete_where(lambda post_id, entry: post_id in post_ids)
+
+# Переключает лайк пользователя. Удаление и вставка не требуют
+# предварительного SELECT, счетчик обновляют триггеры в той же транзакции.
+# Возвращает (поставлен ли лайк, новое число лайков) или None, если поста нет
+def toggle_like(conn, post_id, user_id):
+    removed = conn.execute('''
+        DELETE FROM likes WHERE post_id = ? AND user_id = ? RETURNING id
+    ''', (post_id, user_id)).fetchall()
+    if not removed:
+        added = conn.execute('''
+            INSERT INTO likes (post_id, user_id, ts) 
+            SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM posts WHERE id = ?)
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        ''', (post_id, user_id, now_ms(), post_id)).fetchall()
+        if not added:
+            return None
+    
+    count = conn.execute('SELECT like_count FROM posts WHERE id = ?', (post_id,)).fetchone()[0]
+    return not removed, count
+
+def insert_comment(conn, post_id, user_id, content):
+    conn.execute('''
+        INSERT INTO comments (post_id, user_id, content, ts) VALUES (?, ?, ?, ?)
+    ''', (post_id, user_id, content, now_ms()))
+
+# Операции, которые можно откладывать в буфер отложенной записи,
+# и сброс кэшей после их фиксации
+WRITE_OPERATIONS = {
+    'like': toggle_like,
+    'comment': insert_comment,
+}
+
+def after_writes(operations):
+    for kind, args in operations:
+        if kind == 'comment':
+            invalidate_post(args[0])
+    invalidate_page_cache()
+
+# Буфер отложенной записи (write-behind) для лайков и комментариев.
+# Операции копятся в памяти и фиксируются пачкой в одной транзакции
+# раз в WRITE_BEHIND_INTERVAL_MS или по достижении WRITE_BEHIND_MAX_BATCH,
+# так что на много кликов приходится один fsync.
+# WRITE_BEHIND_DURABILITY=sync: запрос ждет фиксации своей пачки (групповой commit);
+# async: запрос сразу получает ответ, операции теряются при падении процесса.
+# Буфер у каждого процесса свой, поэтому async допустим только с одним
+# воркером: иначе следующий запрос пользователя попадет в воркер, который
+# о его записи не знает (gunicorn.conf.py не запустится с такими настройками)
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_INTERVAL_MS = int(os.environ.get('WRITE_BEHIND_INTERVAL_MS', 20))
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 200))
+WRITE_BEHIND_DURABILITY = os.environ.get('WRITE_BEHIND_DURABILITY', 'sync')
+WRITE_BEHIND_TIMEOUT = float(os.environ.get('WRITE_BEHIND_TIMEOUT', 10))
+
+# Результат операции, которую поставили в очередь и не стали ждать
+QUEUED = object()
+
+class PendingWrite:
+    def __init__(self, kind, args, user_id):
+        self.kind = kind
+        self.args = args
+        self.user_id = user_id
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+    
+    def wait(self):
+        if not self.done.wait(WRITE_BEHIND_TIMEOUT):
+            raise TimeoutError('Отложенная запись не была зафиксирована вовремя')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class WriteBehindBuffer:
+    def __init__(self):
+        self._pending = []
+        # Пачка, которая сейчас фиксируется: ее операции еще не видны
+        # другим соединениям, значит, для читателя они тоже в очереди
+        self._in_flight = []
+        self._condition = threading.Condition()
+        # Один сброс за раз: фоновый поток и запрос, которому нужно
+        # прочитать свои записи, не должны фиксировать пачки параллельно
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.batches = 0
+        self.operations = 0
+        self.max_batch = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+    
+    def submit(self, kind, args, user_id):
+        operation = PendingWrite(kind, args, user_id)
+        with self._condition:
+            self._ensure_thread()
+            self._pending.append(operation)
+            if len(self._pending) >= WRITE_BEHIND_MAX_BATCH:
+                self._condition.notify()
+        return operation
+    
+    def has_pending(self, user_id):
+        with self._condition:
+            return any(operation.user_id == user_id
+                       for operation in self._pending + self._in_flight)
+    
+    def _ensure_thread(self):
+        # Поток сброса запускается в том процессе, который принимает запросы
+        if self._pid != os.getpid():
+            # Очередь, унаследованную от родителя при fork, фиксирует сам родитель
+            self._pid = os.getpid()
+            self._pending = []
+            self._in_flight = []
+            self._thread = None
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='edirt-write-behind', daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: len(self._pending) >= WRITE_BEHIND_MAX_BATCH,
+                    timeout=WRITE_BEHIND_INTERVAL_MS / 1000,
+                )
+            self.flush()
+    
+    def flush(self):
+        with self._flush_lock:
+            with self._condition:
+                batch = self._pending[:WRITE_BEHIND_MAX_BATCH]
+                del self._pending[:WRITE_BEHIND_MAX_BATCH]
+                self._in_flight = batch
+            if not batch:
+                return 0
+            
+            started = time.perf_counter()
+            try:
+                with app.app_context(), write_transaction() as conn:
+                    for operation in batch:
+                        # Точка сохранения не дает одной ошибочной операции
+                        # откатить всю пачку
+                        conn.execute('SAVEPOINT write_behind_op')
+                        try:
+                            operation.result = WRITE_OPERATIONS[operation.kind](conn, *operation.args)
+                        except sqlite3.Error as e:
+                            conn.execute('ROLLBACK TO write_behind_op')
+                            operation.error = e
+                        conn.execute('RELEASE write_behind_op')
+            except Exception as e:
+                print(f"Error flushing write-behind batch: {e}")
+                self.errors += 1
+                for operation in batch:
+                    operation.error = e
+            else:
+                after_writes([(operation.kind, operation.args) for operation in batch])
+            
+            elapsed = (time.perf_counter() - started) * 1000
+            self.batches += 1
+            self.operations += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            self.total_flush_ms += elapsed
+            with self._condition:
+                self._in_flight = []
+            for operation in batch:
+                operation.done.set()
+            return len(batch)
+    
+    def drain(self):
+        while self.flush():
+            pass
+    
+    def stats(self):
+        return {
+            'enabled': WRITE_BEHIND,
+            'durability': WRITE_BEHIND_DURABILITY,
+            'pending': len(self._pending),
+            'batches': self.batches,
+            'operations': self.operations,
+            'avg_batch': round(self.operations / self.batches, 2) if self.batches else 0.0,
+            'max_batch': self.max_batch,
+            'errors': self.errors,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'avg_flush_ms': round(self.total_flush_ms / self.batches, 3) if self.batches else 0.0,
+        }
+
+write_behind = WriteBehindBuffer()
+# При штатной остановке воркера дописываем все, что осталось в буфере
+atexit.register(write_behind.drain)
+
+def submit_write(kind, *args, wait=True):
+    if not WRITE_BEHIND:
+        with write_transaction() as conn:
+            result = WRITE_OPERATIONS[kind](conn, *args)
+        after_writes([(kind, args)])
+        return result
+    
+    operation = write_behind.submit(kind, args, session.get('user_id'))
+    if not wait:
+        return QUEUED
+    return operation.wait()
+
+def read_own_writes():
+    # Пользователь должен видеть свои лайки и комментарии сразу,
+    # поэтому перед чтением сбрасываем буфер, если в нем есть его операции.
+    # Если его пачку уже фиксирует другой поток, flush дождется ее на
+    # _flush_lock
+    user_id = session.get('user_id')
+    while WRITE_BEHIND and user_id and write_behind.has_pending(user_id):
+        write_behind.flush()
+
+# Последние комментарии каждого поста одним запросом. Для каждого поста
+# подзапрос с LIMIT проходит по индексу (post_id, ts, id) от конца и
+# останавливается на limit строках, так что размер обсуждения не важен
+def load_comments_by_post(conn, post_ids, limit=FEED_COMMENTS_LIMIT):
+    comments_by_post = {post_id: [] for post_id in post_ids}
+    if not post_ids:
+        return comments_by_post
+    
+    for comment in conn.execute('''
+        SELECT comments.*, users.username 
+        FROM json_each(?) AS feed_posts 
+        JOIN comments ON comments.id IN (
+            SELECT recent.id FROM comments AS recent 
+            WHERE recent.post_id = feed_posts.value 
+            ORDER BY recent.ts DESC, recent.id DESC
+            LIMIT ?
+        )
+        JOIN users ON comments.user_id = users.id 
+        ORDER BY comments.ts ASC, comments.id ASC
+    ''', (json.dumps(list(post_ids)), limit)):
+        comments_by_post[comment['post_id']].append(comment)
+    return comments_by_post
+
+# Страница более ранних комментариев поста перед курсором,
+# в хронологическом порядке, как в ленте
+def fetch_older_comments(conn, post_id, cursor, limit):
+    comments = conn.execute('''
+        SELECT comments.*, users.username 
+        FROM comments 
+        JOIN users ON comments.user_id = users.id 
+        WHERE comments.post_id = ? 
+          AND (comments.ts, comments.id) < (?, ?)
+        ORDER BY comments.ts DESC, comments.id DESC
+        LIMIT ?
+    ''', (post_id, cursor[0], cursor[1], limit + 1)).fetchall()
+    
+    next_cursor = None
+    if len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = make_feed_cursor(comments[-1])
+    comments.reverse()
+    return comments, next_cursor
+
+def load_liked_post_ids(conn, viewer_id, post_ids):
+    if not viewer_id or not post_ids:
+        return set()
+    
+    placeholders = ','.join('?' * len(post_ids))
+    return {row['post_id'] for row in conn.execute(f'''
+        SELECT post_id FROM likes 
+        WHERE user_id = ? AND post_id IN ({placeholders})
+    ''', [viewer_id] + post_ids)}
+
+# Собирает данные для страницы ленты фиксированным числом запросов.
+# Нейтральные части постов берутся из кэша фрагментов, комментарии
+# загружаются одним запросом только для постов, которых в кэше нет,
+# а поверх накладываются данные зрителя: его лайки и счетчик лайков
+def load_feed_posts(conn, posts, viewer_id=None):
+    if not posts:
+        return []
+    
+    fragments = {}
+    stale_posts = []
+    for post in posts:
+        entry = post_fragment_cache.get(post['id'])
+        if entry is not None and entry['version'] == post_version(post):
+            fragments[post['id']] = entry
+        else:
+            stale_posts.append(post)
+    
+    if stale_posts:
+        macros = app.jinja_env.get_template('post_fragments.html').module
+        comments_by_post = load_comments_by_post(conn, [post['id'] for post in stale_posts])
+        for post in stale_posts:
+            entry = {
+                'version': post_version(post),
+                'user_id': post['user_id'],
+                'body_html': macros.post_body(post),
+                'comments_html': macros.post_comments(post, comments_by_post[post['id']]),
+            }
+            post_fragment_cache.set(post['id'], entry)
+            fragments[post['id']] = entry
+    
+    liked_post_ids = load_liked_post_ids(conn, viewer_id, [post['id'] for post in posts])
+    
+    posts_list = []
+    for post in posts:
+        entry = fragments[post['id']]
+        posts_list.append({
+            'id': post['id'],
+            'user_id': post['user_id'],
+            'body_html': entry['body_html'],
+            'comments_html': entry['comments_html'],
+            'likes': post['like_count'],
+            'comment_count': post['comment_count'],
+            'user_liked': post['id'] in liked_post_ids
+        })
+    return posts_list
+
 # HTML шаблоны
 INDEX_TEMPLATE = '''
 <!DOCTYPE html>
@@ -104,397 +1257,14 @@ INDEX_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Edirt - Социальная сеть</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-        }
-        
-        .navbar {
-            background: white;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            padding: 1rem 0;
-            position: sticky;
-            top: 0;
-            z-index: 100;
-        }
-        
-        .nav-container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            font-size: 2rem;
-            font-weight: bold;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            text-decoration: none;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            text-decoration: none;
-            color: #666;
-            font-weight: 500;
-            transition: color 0.3s;
-        }
-        
-        .nav-links a:hover {
-            color: #667eea;
-        }
-        
-        .admin-badge {
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-            color: white;
-            padding: 5px 10px;
-            border-radius: 20px;
-            font-size: 12px;
-            margin-left: 10px;
-        }
-        
-        .banned-badge {
-            background: #e74c3c;
-            color: white;
-            padding: 5px 10px;
-            border-radius: 20px;
-            font-size: 12px;
-        }
-        
-        .container {
-            max-width: 800px;
-            margin: 40px auto;
-            padding: 0 20px;
-        }
-        
-        .card {
-            background: white;
-            border-radius: 15px;
-            padding: 30px;
-            box-shadow: 0 10px 40px rgba(0,0,0,0.1);
-            margin-bottom: 30px;
-            animation: slideIn 0.5s ease-out;
-        }
-        
-        @keyframes slideIn {
-            from {
-                opacity: 0;
-                transform: translateY(20px);
-            }
-            to {
-                opacity: 1;
-                transform: translateY(0);
-            }
-        }
-        
-        .form-group {
-            margin-bottom: 20px;
-        }
-        
-        .form-group label {
-            display: block;
-            margin-bottom: 8px;
-            color: #555;
-            font-weight: 500;
-        }
-        
-        .form-control {
-            width: 100%;
-            padding: 12px;
-            border: 2px solid #e0e0e0;
-            border-radius: 8px;
-            font-size: 16px;
-            transition: border-color 0.3s;
-        }
-        
-        .form-control:focus {
-            outline: none;
-            border-color: #667eea;
-        }
-        
-        textarea.form-control {
-            min-height: 120px;
-            resize: vertical;
-        }
-        
-        .btn {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            border: none;
-            padding: 12px 30px;
-            border-radius: 8px;
-            font-size: 16px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: transform 0.3s, box-shadow 0.3s;
-            text-decoration: none;
-            display: inline-block;
-        }
-        
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 5px 20px rgba(102, 126, 234, 0.4);
-        }
-        
-        .btn-small {
-            padding: 8px 20px;
-            font-size: 14px;
-        }
-        
-        .btn-danger {
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-        }
-        
-        .btn-warning {
-            background: #f39c12;
-        }
-        
-        .btn-secondary {
-            background: #999;
-            margin-left: 10px;
-        }
-        
-        .post {
-            border-bottom: 1px solid #eee;
-            padding: 25px 0;
-            animation: slideIn 0.5s ease-out;
-            position: relative;
-        }
-        
-        .post:last-child {
-            border-bottom: none;
-        }
-        
-        .post.banned {
-            opacity: 0.5;
-            background: #fff5f5;
-            padding: 25px;
-            border-radius: 10px;
-        }
-        
-        .post-header {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            margin-bottom: 15px;
-        }
-        
-        .post-author {
-            font-weight: 600;
-            color: #667eea;
-            font-size: 1.1rem;
-        }
-        
-        .post-author.admin {
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-        }
-        
-        .post-date {
-            color: #999;
-            font-size: 0.9rem;
-        }
-        
-        .post-content {
-            color: #444;
-            line-height: 1.6;
-            margin-bottom: 20px;
-            font-size: 1.1rem;
-        }
-        
-        .admin-actions {
-            position: absolute;
-            top: 25px;
-            right: 0;
-            display: flex;
-            gap: 10px;
-        }
-        
-        .admin-btn {
-            padding: 5px 10px;
-            font-size: 12px;
-            border: none;
-            border-radius: 5px;
-            cursor: pointer;
-            color: white;
-            transition: transform 0.3s;
-        }
-        
-        .admin-btn:hover {
-            transform: scale(1.05);
-        }
-        
-        .ban-user-btn {
-            background: #e74c3c;
-        }
-        
-        .ban-post-btn {
-            background: #f39c12;
-        }
-        
-        .unban-user-btn {
-            background: #27ae60;
-        }
-        
-        .unban-post-btn {
-            background: #3498db;
-        }
-        
-        .post-actions {
-            display: flex;
-            gap: 20px;
-            margin-bottom: 20px;
-        }
-        
-        .like-btn {
-            background: none;
-            border: none;
-            color: #e74c3c;
-            font-size: 1.2rem;
-            cursor: pointer;
-            display: flex;
-            align-items: center;
-            gap: 5px;
-            transition: transform 0.3s;
-        }
-        
-        .like-btn:hover {
-            transform: scale(1.1);
-        }
-        
-        .like-btn.liked {
-            color: #c0392b;
-        }
-        
-        .comment-section {
-            background: #f9f9f9;
-            border-radius: 10px;
-            padding: 20px;
-            margin-top: 20px;
-        }
-        
-        .comment {
-            padding: 15px 0;
-            border-bottom: 1px solid #e0e0e0;
-        }
-        
-        .comment:last-child {
-            border-bottom: none;
-        }
-        
-        .comment-author {
-            font-weight: 600;
-            color: #667eea;
-            margin-bottom: 5px;
-        }
-        
-        .comment-text {
-            color: #666;
-            line-height: 1.4;
-        }
-        
-        .comment-date {
-            font-size: 0.8rem;
-            color: #999;
-            margin-top: 5px;
-        }
-        
-        .alert {
-            padding: 15px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-        }
-        
-        .alert-success {
-            background: #d4edda;
-            color: #155724;
-            border: 1px solid #c3e6cb;
-        }
-        
-        .alert-error {
-            background: #f8d7da;
-            color: #721c24;
-            border: 1px solid #f5c6cb;
-        }
-        
-        .alert-warning {
-            background: #fff3cd;
-            color: #856404;
-            border: 1px solid #ffeeba;
-        }
-        
-        .welcome-text {
-            text-align: center;
-            color: white;
-            margin-bottom: 40px;
-        }
-        
-        .welcome-text h1 {
-            font-size: 3rem;
-            margin-bottom: 10px;
-        }
-        
-        .welcome-text p {
-            font-size: 1.2rem;
-            opacity: 0.9;
-        }
-        
-        .empty-state {
-            text-align: center;
-            color: #999;
-            padding: 40px;
-        }
-        
-        .user-list {
-            margin-top: 20px;
-        }
-        
-        .user-item {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            padding: 15px;
-            border-bottom: 1px solid #eee;
-        }
-        
-        .user-item:last-child {
-            border-bottom: none;
-        }
-        
-        .user-info {
-            display: flex;
-            align-items: center;
-            gap: 15px;
-        }
-        
-        .user-name {
-            font-weight: 600;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('edirt.css') }}">
 </head>
 <body>
     <nav class="navbar">
         <div class="nav-container">
             <a href="/" class="logo">Edirt</a>
             <div class="nav-links">
+                <a href="/search">Поиск</a>
                 {% if session.user_id %}
                     {% if session.is_admin %}
                         <span class="admin-badge">Админ</span>
@@ -528,7 +1298,10 @@ INDEX_TEMPLATE = '''
         <div class="card">
             <h2 style="margin-bottom: 20px;">Последние истории</h2>
             
-            {% if posts %}
+            <a href="/" class="new-posts-notice" hidden>Появились новые истории — обновить ленту</a>
+            {{ stream_flush() }}
+            
+            {% for posts in post_chunks %}
                 {% for post in posts %}
                     <div class="post">
                         {% if session.is_admin %}
@@ -542,40 +1315,18 @@ INDEX_TEMPLATE = '''
                             </div>
                         {% endif %}
                         
-                        <div class="post-header">
-                            <span class="post-author {% if post.is_admin %}admin{% endif %}">
-                                {{ post.display_name or post.username }}
-                                {% if post.is_admin %}
-                                    <span class="admin-badge">Официальный</span>
-                                {% endif %}
-                            </span>
-                            <span class="post-date">{{ post.created_at }}</span>
-                        </div>
-                        
-                        <div class="post-content">{{ post.content }}</div>
+                        {{ post.body_html }}
                         
                         <div class="post-actions">
-                            <form action="/like/{{ post.id }}" method="post" style="display: inline;">
+                            <form action="/like/{{ post.id }}" method="post" class="like-form" data-api="{{ url_for('api_like_post', post_id=post.id) }}" style="display: inline;">
                                 <button type="submit" class="like-btn {% if post.user_liked %}liked{% endif %}" {% if session.user_banned %}disabled{% endif %}>
-                                    ❤️ {{ post.likes }}
+                                    ❤️ <span class="like-count">{{ post.likes }}</span>
                                 </button>
                             </form>
                         </div>
                         
                         <div class="comment-section">
-                            <h3 style="margin-bottom: 15px;">Комментарии</h3>
-                            
-                            {% if post.comments %}
-                                {% for comment in post.comments %}
-                                    <div class="comment">
-                                        <div class="comment-author">{{ comment.username }}</div>
-                                        <div class="comment-text">{{ comment.content }}</div>
-                                        <div class="comment-date">{{ comment.created_at }}</div>
-                                    </div>
-                                {% endfor %}
-                            {% else %}
-                                <p style="color: #999; text-align: center;">Пока нет комментариев</p>
-                            {% endif %}
+                            {{ post.comments_html }}
                             
                             {% if session.user_id and not session.user_banned %}
                                 <form action="/comment/{{ post.id }}" method="post" style="margin-top: 20px;">
@@ -587,19 +1338,147 @@ INDEX_TEMPLATE = '''
                             {% elif session.user_banned %}
                                 <p style="color: #e74c3c; text-align: center;">Ваш аккаунт забанен. Вы не можете оставлять комментарии.</p>
                             {% endif %}
-                        </div>
-                    </div>
-                {% endfor %}
-            {% else %}
-                <div class="empty-state">
-                    <p>Пока нет ни одной истории. Будьте первым!</p>
-                    {% if session.user_id and not session.user_banned %}
-                        <a href="/create_post" class="btn" style="display: inline-block; margin-top: 20px;">Создать пост</a>
+                        </div>
+                    </div>
+                {% endfor %}
+                {{ stream_flush() }}
+                
+                {% if loop.last %}
+                    <div class="feed-pagination">
+                        {% if not is_first_page %}
+                            <a href="/" class="btn btn-small btn-secondary">К новым историям</a>
+                        {% endif %}
+                        {% if next_cursor %}
+                            <a href="{{ url_for('index', before=next_cursor) }}" class="btn btn-small">Более старые истории →</a>
+                        {% endif %}
+                    </div>
+                {% endif %}
+            {% else %}
+                <div class="empty-state">
+                    <p>Пока нет ни одной истории. Будьте первым!</p>
+                    {% if session.user_id and not session.user_banned %}
+                        <a href="/create_post" class="btn" style="display: inline-block; margin-top: 20px;">Создать пост</a>
+                    {% endif %}
+                </div>
+            {% endfor %}
+        </div>
+    </div>
+    <script src="{{ asset_url('edirt.js') }}" defer></script>
+</body>
+</html>
+'''
+
+# Части поста, не зависящие от зрителя. Они рендерятся один раз
+# и хранятся в кэше фрагментов, пока пост не изменится
+POST_FRAGMENTS_TEMPLATE = '''
+{% macro post_body(post) %}
+                        <div class="post-header">
+                            <span class="post-author {% if post.is_admin %}admin{% endif %}">
+                                {{ post.display_name or post.username }}
+                                {% if post.is_admin %}
+                                    <span class="admin-badge">Официальный</span>
+                                {% endif %}
+                            </span>
+                            <span class="post-date">{{ post.ts|datetime }}</span>
+                        </div>
+                        
+                        <div class="post-content">{{ post.content }}</div>
+{% endmacro %}
+
+{% macro comment_list(comments) %}
+                                {% for comment in comments %}
+                                    <div class="comment">
+                                        <div class="comment-author">{{ comment.username }}</div>
+                                        <div class="comment-text">{{ comment.content }}</div>
+                                        <div class="comment-date">{{ comment.ts|datetime }}</div>
+                                    </div>
+                                {% endfor %}
+{% endmacro %}
+
+{% macro older_comments_link(post_id, before) %}
+                                <a href="{{ url_for('post_comments', post_id=post_id, before=before) }}" class="older-comments">Показать более ранние комментарии</a>
+{% endmacro %}
+
+{% macro post_comments(post, comments) %}
+                            <h3 style="margin-bottom: 15px;">Комментарии{% if post.comment_count %} ({{ post.comment_count }}){% endif %}</h3>
+                            
+                            {% if comments %}
+                                {% if post.comment_count > comments|length %}
+                                    {{ older_comments_link(post.id, comments[0].ts ~ ',' ~ comments[0].id) }}
+                                {% endif %}
+                                {{ comment_list(comments) }}
+                            {% else %}
+                                <p style="color: #999; text-align: center;">Пока нет комментариев</p>
+                            {% endif %}
+{% endmacro %}
+'''
+
+# Более ранние комментарии поста. Фрагмент подставляется скриптом
+# на место ссылки, вместе со ссылкой на следующую порцию
+OLDER_COMMENTS_TEMPLATE = '''
+{% from 'post_fragments.html' import comment_list, older_comments_link %}
+{% if next_cursor %}
+    {{ older_comments_link(post_id, next_cursor) }}
+{% endif %}
+{{ comment_list(comments) }}
+'''
+
+# Те же комментарии отдельной страницей, если ссылку открыли без скрипта
+POST_COMMENTS_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="ru">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Edirt - Комментарии</title>
+    <link rel="stylesheet" href="{{ asset_url('edirt.css') }}">
+</head>
+<body>
+    <nav class="navbar">
+        <div class="nav-container">
+            <a href="/" class="logo">Edirt</a>
+            <div class="nav-links">
+                <a href="/search">Поиск</a>
+                {% if session.user_id %}
+                    {% if session.is_admin %}
+                        <span class="admin-badge">Админ</span>
+                        <a href="/admin/users">Управление пользователями</a>
+                    {% endif %}
+                    <a href="/create_post">+ Создать пост</a>
+                    <a href="/logout">Выйти ({{ session.display_name or session.username }})</a>
+                {% else %}
+                    <a href="/login">Войти</a>
+                    <a href="/register">Регистрация</a>
+                {% endif %}
+            </div>
+        </div>
+    </nav>
+    
+    <div class="container">
+        {% from 'post_fragments.html' import post_body, comment_list, older_comments_link %}
+        <div class="card">
+            <div class="post">
+                {{ post_body(post) }}
+                
+                <div class="comment-section">
+                    <h3 style="margin-bottom: 15px;">Более ранние комментарии</h3>
+                    {% if next_cursor %}
+                        {{ older_comments_link(post.id, next_cursor) }}
+                    {% endif %}
+                    {% if comments %}
+                        {{ comment_list(comments) }}
+                    {% else %}
+                        <p style="color: #999; text-align: center;">Более ранних комментариев нет</p>
                     {% endif %}
                 </div>
-            {% endif %}
+            </div>
+            
+            <div class="feed-pagination">
+                <a href="/" class="btn btn-small btn-secondary">← К ленте</a>
+            </div>
         </div>
     </div>
+    <script src="{{ asset_url('edirt.js') }}" defer></script>
 </body>
 </html>
 '''
@@ -611,182 +1490,14 @@ CREATE_POST_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Edirt - Создать пост</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-        }
-        
-        .navbar {
-            background: white;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            padding: 1rem 0;
-            position: sticky;
-            top: 0;
-            z-index: 100;
-        }
-        
-        .nav-container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            font-size: 2rem;
-            font-weight: bold;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            text-decoration: none;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            text-decoration: none;
-            color: #666;
-            font-weight: 500;
-            transition: color 0.3s;
-        }
-        
-        .nav-links a:hover {
-            color: #667eea;
-        }
-        
-        .admin-badge {
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-            color: white;
-            padding: 5px 10px;
-            border-radius: 20px;
-            font-size: 12px;
-            margin-left: 10px;
-        }
-        
-        .container {
-            max-width: 800px;
-            margin: 40px auto;
-            padding: 0 20px;
-        }
-        
-        .card {
-            background: white;
-            border-radius: 15px;
-            padding: 30px;
-            box-shadow: 0 10px 40px rgba(0,0,0,0.1);
-            margin-bottom: 30px;
-            animation: slideIn 0.5s ease-out;
-        }
-        
-        @keyframes slideIn {
-            from {
-                opacity: 0;
-                transform: translateY(20px);
-            }
-            to {
-                opacity: 1;
-                transform: translateY(0);
-            }
-        }
-        
-        .form-group {
-            margin-bottom: 20px;
-        }
-        
-        .form-group label {
-            display: block;
-            margin-bottom: 8px;
-            color: #555;
-            font-weight: 500;
-        }
-        
-        .form-control {
-            width: 100%;
-            padding: 12px;
-            border: 2px solid #e0e0e0;
-            border-radius: 8px;
-            font-size: 16px;
-            transition: border-color 0.3s;
-        }
-        
-        .form-control:focus {
-            outline: none;
-            border-color: #667eea;
-        }
-        
-        textarea.form-control {
-            min-height: 120px;
-            resize: vertical;
-        }
-        
-        .btn {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            border: none;
-            padding: 12px 30px;
-            border-radius: 8px;
-            font-size: 16px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: transform 0.3s, box-shadow 0.3s;
-            text-decoration: none;
-            display: inline-block;
-        }
-        
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 5px 20px rgba(102, 126, 234, 0.4);
-        }
-        
-        .btn-secondary {
-            background: #999;
-            margin-left: 10px;
-        }
-        
-        .alert {
-            padding: 15px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-        }
-        
-        .alert-success {
-            background: #d4edda;
-            color: #155724;
-            border: 1px solid #c3e6cb;
-        }
-        
-        .alert-error {
-            background: #f8d7da;
-            color: #721c24;
-            border: 1px solid #f5c6cb;
-        }
-        
-        .alert-warning {
-            background: #fff3cd;
-            color: #856404;
-            border: 1px solid #ffeeba;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('edirt.css') }}">
 </head>
 <body>
     <nav class="navbar">
         <div class="nav-container">
             <a href="/" class="logo">Edirt</a>
             <div class="nav-links">
+                <a href="/search">Поиск</a>
                 {% if session.user_id %}
                     {% if session.is_admin %}
                         <span class="admin-badge">Админ</span>
@@ -834,180 +1545,25 @@ CREATE_POST_TEMPLATE = '''
 </html>
 '''
 
-LOGIN_TEMPLATE = '''
+SEARCH_TEMPLATE = '''
 <!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Edirt - Вход</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-        }
-        
-        .navbar {
-            background: white;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            padding: 1rem 0;
-            position: sticky;
-            top: 0;
-            z-index: 100;
-        }
-        
-        .nav-container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            font-size: 2rem;
-            font-weight: bold;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            text-decoration: none;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            text-decoration: none;
-            color: #666;
-            font-weight: 500;
-            transition: color 0.3s;
-        }
-        
-        .nav-links a:hover {
-            color: #667eea;
-        }
-        
-        .container {
-            max-width: 500px;
-            margin: 40px auto;
-            padding: 0 20px;
-        }
-        
-        .card {
-            background: white;
-            border-radius: 15px;
-            padding: 30px;
-            box-shadow: 0 10px 40px rgba(0,0,0,0.1);
-            margin-bottom: 30px;
-            animation: slideIn 0.5s ease-out;
-        }
-        
-        @keyframes slideIn {
-            from {
-                opacity: 0;
-                transform: translateY(20px);
-            }
-            to {
-                opacity: 1;
-                transform: translateY(0);
-            }
-        }
-        
-        .form-group {
-            margin-bottom: 20px;
-        }
-        
-        .form-group label {
-            display: block;
-            margin-bottom: 8px;
-            color: #555;
-            font-weight: 500;
-        }
-        
-        .form-control {
-            width: 100%;
-            padding: 12px;
-            border: 2px solid #e0e0e0;
-            border-radius: 8px;
-            font-size: 16px;
-            transition: border-color 0.3s;
-        }
-        
-        .form-control:focus {
-            outline: none;
-            border-color: #667eea;
-        }
-        
-        .btn {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            border: none;
-            padding: 12px 30px;
-            border-radius: 8px;
-            font-size: 16px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: transform 0.3s, box-shadow 0.3s;
-            width: 100%;
-        }
-        
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 5px 20px rgba(102, 126, 234, 0.4);
-        }
-        
-        .alert {
-            padding: 15px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-        }
-        
-        .alert-success {
-            background: #d4edda;
-            color: #155724;
-            border: 1px solid #c3e6cb;
-        }
-        
-        .alert-error {
-            background: #f8d7da;
-            color: #721c24;
-            border: 1px solid #f5c6cb;
-        }
-        
-        .link {
-            text-align: center;
-            margin-top: 20px;
-        }
-        
-        .link a {
-            color: #667eea;
-            text-decoration: none;
-        }
-        
-        .link a:hover {
-            text-decoration: underline;
-        }
-    </style>
+    <title>Edirt - Поиск</title>
+    <link rel="stylesheet" href="{{ asset_url('edirt.css') }}">
 </head>
 <body>
     <nav class="navbar">
         <div class="nav-container">
             <a href="/" class="logo">Edirt</a>
             <div class="nav-links">
+                <a href="/search">Поиск</a>
                 {% if session.user_id %}
                     {% if session.is_admin %}
                         <span class="admin-badge">Админ</span>
+                        <a href="/admin/users">Управление пользователями</a>
                     {% endif %}
                     <a href="/create_post">+ Создать пост</a>
                     <a href="/logout">Выйти ({{ session.display_name or session.username }})</a>
@@ -1020,208 +1576,123 @@ LOGIN_TEMPLATE = '''
     </nav>
     
     <div class="container">
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="alert alert-{{ category }}">{{ message }}</div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        
         <div class="card">
-            <h2 style="margin-bottom: 20px; text-align: center;">Вход в Edirt</h2>
+            <h2 style="margin-bottom: 20px;">Поиск</h2>
             
-            <form action="/login" method="post">
-                <div class="form-group">
-                    <label for="username">Имя пользователя</label>
-                    <input type="text" id="username" name="username" class="form-control" required>
-                </div>
-                <div class="form-group">
-                    <label for="password">Пароль</label>
-                    <input type="password" id="password" name="password" class="form-control" required>
-                </div>
-                <button type="submit" class="btn">Войти</button>
-                <div class="link">
-                    Нет аккаунта? <a href="/register">Зарегистрируйтесь</a>
-                </div>
+            <form action="/search" method="get" class="search-form">
+                <input type="search" name="q" value="{{ query }}" class="form-control" placeholder="Что ищем?" autofocus>
+                <select name="type" class="form-control">
+                    <option value="posts" {% if search_type == 'posts' %}selected{% endif %}>Истории</option>
+                    <option value="comments" {% if search_type == 'comments' %}selected{% endif %}>Комментарии</option>
+                </select>
+                <button type="submit" class="btn">Найти</button>
             </form>
+            
+            {% if query %}
+                {% if results %}
+                    {% for result in results %}
+                        <div class="search-result">
+                            <div class="post-header">
+                                <span class="post-author">{{ result.display_name or result.username }}</span>
+                                <span class="post-date">{{ result.ts|datetime }}</span>
+                            </div>
+                            <div class="post-content">{{ result.snippet }}</div>
+                        </div>
+                    {% endfor %}
+                    
+                    {% if next_cursor %}
+                        <div class="feed-pagination">
+                            <a href="{{ url_for('search', q=query, type=search_type, after=next_cursor) }}" class="btn btn-small">Еще результаты →</a>
+                        </div>
+                    {% endif %}
+                {% else %}
+                    <div class="empty-state">
+                        <p>Ничего не найдено</p>
+                    </div>
+                {% endif %}
+            {% endif %}
         </div>
     </div>
 </body>
 </html>
 '''
 
-REGISTER_TEMPLATE = '''
+LOGIN_TEMPLATE = '''
 <!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Edirt - Регистрация</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-        }
-        
-        .navbar {
-            background: white;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            padding: 1rem 0;
-            position: sticky;
-            top: 0;
-            z-index: 100;
-        }
-        
-        .nav-container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            font-size: 2rem;
-            font-weight: bold;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            text-decoration: none;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            text-decoration: none;
-            color: #666;
-            font-weight: 500;
-            transition: color 0.3s;
-        }
-        
-        .nav-links a:hover {
-            color: #667eea;
-        }
-        
-        .container {
-            max-width: 500px;
-            margin: 40px auto;
-            padding: 0 20px;
-        }
-        
-        .card {
-            background: white;
-            border-radius: 15px;
-            padding: 30px;
-            box-shadow: 0 10px 40px rgba(0,0,0,0.1);
-            margin-bottom: 30px;
-            animation: slideIn 0.5s ease-out;
-        }
-        
-        @keyframes slideIn {
-            from {
-                opacity: 0;
-                transform: translateY(20px);
-            }
-            to {
-                opacity: 1;
-                transform: translateY(0);
-            }
-        }
-        
-        .form-group {
-            margin-bottom: 20px;
-        }
-        
-        .form-group label {
-            display: block;
-            margin-bottom: 8px;
-            color: #555;
-            font-weight: 500;
-        }
-        
-        .form-control {
-            width: 100%;
-            padding: 12px;
-            border: 2px solid #e0e0e0;
-            border-radius: 8px;
-            font-size: 16px;
-            transition: border-color 0.3s;
-        }
-        
-        .form-control:focus {
-            outline: none;
-            border-color: #667eea;
-        }
-        
-        .btn {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            border: none;
-            padding: 12px 30px;
-            border-radius: 8px;
-            font-size: 16px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: transform 0.3s, box-shadow 0.3s;
-            width: 100%;
-        }
-        
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 5px 20px rgba(102, 126, 234, 0.4);
-        }
-        
-        .alert {
-            padding: 15px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-        }
-        
-        .alert-success {
-            background: #d4edda;
-            color: #155724;
-            border: 1px solid #c3e6cb;
-        }
-        
-        .alert-error {
-            background: #f8d7da;
-            color: #721c24;
-            border: 1px solid #f5c6cb;
-        }
-        
-        .link {
-            text-align: center;
-            margin-top: 20px;
-        }
-        
-        .link a {
-            color: #667eea;
-            text-decoration: none;
-        }
+    <title>Edirt - Вход</title>
+    <link rel="stylesheet" href="{{ asset_url('edirt.css') }}">
+</head>
+<body class="page-auth">
+    <nav class="navbar">
+        <div class="nav-container">
+            <a href="/" class="logo">Edirt</a>
+            <div class="nav-links">
+                <a href="/search">Поиск</a>
+                {% if session.user_id %}
+                    {% if session.is_admin %}
+                        <span class="admin-badge">Админ</span>
+                    {% endif %}
+                    <a href="/create_post">+ Создать пост</a>
+                    <a href="/logout">Выйти ({{ session.display_name or session.username }})</a>
+                {% else %}
+                    <a href="/login">Войти</a>
+                    <a href="/register">Регистрация</a>
+                {% endif %}
+            </div>
+        </div>
+    </nav>
+    
+    <div class="container">
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                {% for category, message in messages %}
+                    <div class="alert alert-{{ category }}">{{ message }}</div>
+                {% endfor %}
+            {% endif %}
+        {% endwith %}
         
-        .link a:hover {
-            text-decoration: underline;
-        }
-    </style>
+        <div class="card">
+            <h2 style="margin-bottom: 20px; text-align: center;">Вход в Edirt</h2>
+            
+            <form action="/login" method="post">
+                <div class="form-group">
+                    <label for="username">Имя пользователя</label>
+                    <input type="text" id="username" name="username" class="form-control" required>
+                </div>
+                <div class="form-group">
+                    <label for="password">Пароль</label>
+                    <input type="password" id="password" name="password" class="form-control" required>
+                </div>
+                <button type="submit" class="btn">Войти</button>
+                <div class="link">
+                    Нет аккаунта? <a href="/register">Зарегистрируйтесь</a>
+                </div>
+            </form>
+        </div>
+    </div>
+</body>
+</html>
+'''
+
+REGISTER_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="ru">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Edirt - Регистрация</title>
+    <link rel="stylesheet" href="{{ asset_url('edirt.css') }}">
 </head>
-<body>
+<body class="page-auth">
     <nav class="navbar">
         <div class="nav-container">
             <a href="/" class="logo">Edirt</a>
             <div class="nav-links">
+                <a href="/search">Поиск</a>
                 {% if session.user_id %}
                     {% if session.is_admin %}
                         <span class="admin-badge">Админ</span>
@@ -1275,190 +1746,14 @@ ADMIN_USERS_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Edirt - Управление пользователями</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-        }
-        
-        .navbar {
-            background: white;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            padding: 1rem 0;
-            position: sticky;
-            top: 0;
-            z-index: 100;
-        }
-        
-        .nav-container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            font-size: 2rem;
-            font-weight: bold;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            text-decoration: none;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            text-decoration: none;
-            color: #666;
-            font-weight: 500;
-            transition: color 0.3s;
-        }
-        
-        .nav-links a:hover {
-            color: #667eea;
-        }
-        
-        .admin-badge {
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-            color: white;
-            padding: 5px 10px;
-            border-radius: 20px;
-            font-size: 12px;
-        }
-        
-        .container {
-            max-width: 1000px;
-            margin: 40px auto;
-            padding: 0 20px;
-        }
-        
-        .card {
-            background: white;
-            border-radius: 15px;
-            padding: 30px;
-            box-shadow: 0 10px 40px rgba(0,0,0,0.1);
-            margin-bottom: 30px;
-            animation: slideIn 0.5s ease-out;
-        }
-        
-        @keyframes slideIn {
-            from {
-                opacity: 0;
-                transform: translateY(20px);
-            }
-            to {
-                opacity: 1;
-                transform: translateY(0);
-            }
-        }
-        
-        .table {
-            width: 100%;
-            border-collapse: collapse;
-        }
-        
-        .table th {
-            text-align: left;
-            padding: 15px;
-            background: #f8f9fa;
-            color: #555;
-            font-weight: 600;
-        }
-        
-        .table td {
-            padding: 15px;
-            border-bottom: 1px solid #eee;
-        }
-        
-        .table tr:hover {
-            background: #f8f9fa;
-        }
-        
-        .btn {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            border: none;
-            padding: 8px 16px;
-            border-radius: 5px;
-            font-size: 14px;
-            cursor: pointer;
-            transition: transform 0.3s;
-            text-decoration: none;
-            display: inline-block;
-        }
-        
-        .btn:hover {
-            transform: translateY(-2px);
-        }
-        
-        .btn-danger {
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-        }
-        
-        .btn-success {
-            background: #27ae60;
-        }
-        
-        .badge {
-            padding: 5px 10px;
-            border-radius: 20px;
-            font-size: 12px;
-            font-weight: 600;
-        }
-        
-        .badge-admin {
-            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-            color: white;
-        }
-        
-        .badge-banned {
-            background: #e74c3c;
-            color: white;
-        }
-        
-        .badge-active {
-            background: #27ae60;
-            color: white;
-        }
-        
-        .alert {
-            padding: 15px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-        }
-        
-        .alert-success {
-            background: #d4edda;
-            color: #155724;
-            border: 1px solid #c3e6cb;
-        }
-        
-        .alert-error {
-            background: #f8d7da;
-            color: #721c24;
-            border: 1px solid #f5c6cb;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('edirt.css') }}">
 </head>
-<body>
+<body class="page-admin">
     <nav class="navbar">
         <div class="nav-container">
             <a href="/" class="logo">Edirt</a>
             <div class="nav-links">
+                <a href="/search">Поиск</a>
                 <span class="admin-badge">Админ</span>
                 <a href="/admin/users">Управление пользователями</a>
                 <a href="/create_post">+ Создать пост</a>
@@ -1479,13 +1774,27 @@ ADMIN_USERS_TEMPLATE = '''
         <div class="card">
             <h2 style="margin-bottom: 20px;">Управление пользователями</h2>
             
+            <form action="/admin/users" method="get" class="search-form">
+                <input type="search" name="q" value="{{ query }}" class="form-control" placeholder="Начало имени пользователя">
+                <select name="status" class="form-control">
+                    <option value="all" {% if status == 'all' %}selected{% endif %}>Все</option>
+                    <option value="active" {% if status == 'active' %}selected{% endif %}>Активные</option>
+                    <option value="banned" {% if status == 'banned' %}selected{% endif %}>Забаненные</option>
+                    <option value="admin" {% if status == 'admin' %}selected{% endif %}>Админы</option>
+                </select>
+                <button type="submit" class="btn">Найти</button>
+            </form>
+            
             <table class="table">
                 <thead>
                     <tr>
+                        <th></th>
                         <th>ID</th>
                         <th>Имя пользователя</th>
                         <th>Отображаемое имя</th>
                         <th>Статус</th>
+                        <th>Посты</th>
+                        <th>Комментарии</th>
                         <th>Дата регистрации</th>
                         <th>Действия</th>
                     </tr>
@@ -1493,6 +1802,11 @@ ADMIN_USERS_TEMPLATE = '''
                 <tbody>
                     {% for user in users %}
                         <tr>
+                            <td>
+                                {% if not user.is_admin %}
+                                    <input type="checkbox" name="ids" value="{{ user.id }}" form="bulk-users">
+                                {% endif %}
+                            </td>
                             <td>{{ user.id }}</td>
                             <td>{{ user.username }}</td>
                             <td>{{ user.display_name or '-' }}</td>
@@ -1505,6 +1819,8 @@ ADMIN_USERS_TEMPLATE = '''
                                     <span class="badge badge-active">Активен</span>
                                 {% endif %}
                             </td>
+                            <td>{{ user.post_count }}</td>
+                            <td>{{ user.comment_count }}</td>
                             <td>{{ user.created_at }}</td>
                             <td>
                                 {% if not user.is_admin %}
@@ -1520,73 +1836,380 @@ ADMIN_USERS_TEMPLATE = '''
                                 {% endif %}
                             </td>
                         </tr>
+                    {% else %}
+                        <tr>
+                            <td colspan="9" class="empty-state">Пользователи не найдены</td>
+                        </tr>
                     {% endfor %}
                 </tbody>
             </table>
             
+            <form id="bulk-users" action="/admin/bulk/users" method="post" class="bulk-actions">
+                <span>Отмеченные пользователи:</span>
+                <button type="submit" name="action" value="ban" class="btn btn-danger">Забанить</button>
+                <button type="submit" name="action" value="unban" class="btn btn-success">Разбанить</button>
+            </form>
+            
+            <div class="feed-pagination">
+                {% if not is_first_page %}
+                    <a href="{{ url_for('admin_users', status=status, q=query or None) }}" class="btn btn-secondary">В начало списка</a>
+                {% endif %}
+                {% if next_cursor %}
+                    <a href="{{ url_for('admin_users', status=status, q=query or None, before=next_cursor) }}" class="btn">Дальше →</a>
+                {% endif %}
+            </div>
+            
             <div style="margin-top: 20px;">
                 <a href="/" class="btn">На главную</a>
             </div>
         </div>
+        
+        <div class="card">
+            <h2 style="margin-bottom: 20px;">Массовая модерация постов</h2>
+            
+            <form action="/admin/bulk/posts" method="post" class="search-form">
+                <input type="number" name="user_id" min="1" class="form-control" placeholder="ID пользователя" required>
+                <input type="datetime-local" name="since" class="form-control" title="Начиная с (UTC), пусто - все посты">
+                <button type="submit" name="action" value="ban" class="btn btn-danger">Забанить посты</button>
+                <button type="submit" name="action" value="unban" class="btn btn-success">Разбанить посты</button>
+            </form>
+        </div>
     </div>
 </body>
 </html>
 '''
 
+# Модерация. Списки id обрабатываются в одной транзакции порциями
+# по BULK_CHUNK_SIZE, чтобы ни один оператор не разрастался. В режиме WAL
+# читатели ленты не ждут этой транзакции, а кэши сбрасываются один раз
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 500))
+BULK_MAX_IDS = int(os.environ.get('BULK_MAX_IDS', 10000))
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def set_users_banned(user_ids, banned):
+    affected = 0
+    with write_transaction() as conn:
+        for chunk in chunked(user_ids, BULK_CHUNK_SIZE):
+            placeholders = ','.join('?' * len(chunk))
+            # Админов забанить нельзя
+            affected += conn.execute(f'''
+                UPDATE users SET is_banned = ? 
+                WHERE id IN ({placeholders}) AND is_banned != ? 
+                  {'AND is_admin = 0' if banned else ''}
+            ''', [int(banned)] + chunk + [int(banned)]).rowcount
+    invalidate_user_posts(*user_ids)
+    invalidate_page_cache()
+    return affected
+
+def set_posts_banned(post_ids, banned):
+    affected = 0
+    with write_transaction() as conn:
+        for chunk in chunked(post_ids, BULK_CHUNK_SIZE):
+            placeholders = ','.join('?' * len(chunk))
+            affected += conn.execute(f'''
+                UPDATE posts SET is_banned = ? 
+                WHERE id IN ({placeholders}) AND is_banned != ?
+            ''', [int(banned)] + chunk + [int(banned)]).rowcount
+    invalidate_posts(post_ids)
+    invalidate_page_cache()
+    return affected
+
+# Посты пользователя начиная с since, порциями по BULK_MAX_IDS. Курсор
+# (ts, id) идет по индексу (user_id, ts), так что каждая порция читается
+# отдельным коротким запросом и между порциями можно писать
+def find_user_post_ids(conn, user_id, since=None):
+    after = (since or 0, 0)
+    while True:
+        rows = conn.execute('''
+            SELECT id, ts FROM posts 
+            WHERE user_id = ? AND (ts, id) > (?, ?)
+            ORDER BY ts, id
+            LIMIT ?
+        ''', (user_id, after[0], after[1], BULK_MAX_IDS)).fetchall()
+        if not rows:
+            return
+        yield [row['id'] for row in rows]
+        after = (rows[-1]['ts'], rows[-1]['id'])
+
+# Шаблоны регистрируются один раз и компилируются Jinja при первом
+# обращении, дальше все запросы используют закэшированные объекты
+TEMPLATES = {
+    'index.html': INDEX_TEMPLATE,
+    'post_fragments.html': POST_FRAGMENTS_TEMPLATE,
+    'older_comments.html': OLDER_COMMENTS_TEMPLATE,
+    'post_comments.html': POST_COMMENTS_TEMPLATE,
+    'create_post.html': CREATE_POST_TEMPLATE,
+    'search.html': SEARCH_TEMPLATE,
+    'login.html': LOGIN_TEMPLATE,
+    'register.html': REGISTER_TEMPLATE,
+    'admin_users.html': ADMIN_USERS_TEMPLATE,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
+
+# Отпечаток исходников шаблонов: входит в ETag страниц и в имя
+# каталога скомпилированных модулей
+TEMPLATES_DIGEST = hashlib.sha256(
+    repr(sorted(TEMPLATES.items())).encode()
+).hexdigest()[:16]
+
+def precompile_templates(base_dir):
+    # Каталог с модулями привязан к хэшу исходников шаблонов, поэтому
+    # после изменения шаблонов устаревшие модули не подхватятся
+    target = os.path.join(base_dir, TEMPLATES_DIGEST)
+    
+    if not os.path.isdir(target):
+        os.makedirs(base_dir, exist_ok=True)
+        # Компилируем во временный каталог и переименовываем его целиком,
+        # чтобы параллельно стартующие воркеры не увидели половину модулей
+        tmp_dir = tempfile.mkdtemp(dir=base_dir)
+        app.jinja_env.compile_templates(tmp_dir, zip=None, ignore_errors=False)
+        try:
+            os.rename(tmp_dir, target)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    # ModuleLoader не отдает исходники, поэтому подключаем его напрямую
+    # к окружению Jinja, оставляя загрузчик Flask запасным вариантом
+    app.jinja_env.loader = ChoiceLoader([ModuleLoader(target), app.jinja_env.loader])
+    return target
+
+def load_templates():
+    if TEMPLATE_MODULES_DIR:
+        target = precompile_templates(TEMPLATE_MODULES_DIR)
+        print(f"Using precompiled templates from {target}")
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
+load_templates()
+
+# Статические ресурсы с отпечатком содержимого в имени файла. Браузеры и
+# прокси могут кэшировать их навсегда, а сжатые варианты готовятся один раз
+ASSET_FILES = ['edirt.css', 'edirt.js']
+ASSET_MIMETYPES = {
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+}
+_assets = {}
+_assets_by_url = {}
+
+def load_assets():
+    static_dir = os.path.join(app.root_path, 'static')
+    for name in ASSET_FILES:
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        variants = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(body)
+        asset = {
+            'filename': f'{stem}.{digest}{ext}',
+            'etag': digest,
+            'mimetype': ASSET_MIMETYPES.get(ext, 'application/octet-stream'),
+            'variants': variants,
+        }
+        _assets[name] = asset
+        _assets_by_url[asset['filename']] = asset
+
+@app.template_global()
+def asset_url(name):
+    return url_for('serve_asset', filename=_assets[name]['filename'])
+
+@app.route('/assets/<filename>')
+def serve_asset(filename):
+    asset = _assets_by_url.get(filename)
+    if asset is None:
+        abort(404)
+    
+    accepted = request.accept_encodings
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in asset['variants'] and accepted[candidate]:
+            encoding = candidate
+            break
+    
+    response = app.response_class(asset['variants'][encoding], mimetype=asset['mimetype'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(asset['etag'])
+    return response.make_conditional(request)
+
+load_assets()
+
+# Сжатие HTML и JSON ответов. Сжатые тела страниц из кэша анонимной
+# ленты сохраняются в той же записи кэша и не сжимаются повторно
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json'}
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, COMPRESSION_LEVEL, mtime=0)
+
+def choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compress_stream(chunks, encoding):
+    # Каждая часть дожимается до границы блока (flush), чтобы браузер
+    # мог показать ее, не дожидаясь конца ответа
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers['Content-Encoding'] = encoding
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+    
+    entry = g.get('page_cache_entry')
+    if entry is not None:
+        compressed = entry.get(encoding)
+        if compressed is None:
+            compressed = entry[encoding] = compress_body(body, encoding)
+    else:
+        compressed = compress_body(body, encoding)
+    
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 # Маршруты Flask
 @app.route('/')
 def index():
-    try:
-        with get_db() as conn:
-            # Получаем все посты от незабаненных пользователей
-            posts = conn.execute('''
-                SELECT posts.*, users.username, users.display_name, users.is_admin, users.is_banned 
-                FROM posts 
-                JOIN users ON posts.user_id = users.id 
-                WHERE users.is_banned = 0
-                ORDER BY posts.created_at DESC
-            ''').fetchall()
-            
-            posts_list = []
-            for post in posts:
-                comments = conn.execute('''
-                    SELECT comments.*, users.username 
-                    FROM comments 
-                    JOIN users ON comments.user_id = users.id 
-                    WHERE comments.post_id = ? 
-                    ORDER BY comments.created_at ASC
-                ''', (post['id'],)).fetchall()
-                
-                likes_count = conn.execute('''
-                    SELECT COUNT(*) as count FROM likes WHERE post_id = ?
-                ''', (post['id'],)).fetchone()['count']
-                
-                user_liked = False
-                if session.get('user_id'):
-                    like = conn.execute('''
-                        SELECT id FROM likes WHERE post_id = ? AND user_id = ?
-                    ''', (post['id'], session['user_id'])).fetchone()
-                    user_liked = like is not None
-                
-                posts_list.append({
-                    'id': post['id'],
-                    'user_id': post['user_id'],
-                    'username': post['username'],
-                    'display_name': post['display_name'],
-                    'is_admin': post['is_admin'],
-                    'content': post['content'],
-                    'created_at': post['created_at'],
-                    'comments': comments,
-                    'likes': likes_count,
-                    'user_liked': user_liked
-                })
-            
-            return render_template_string(INDEX_TEMPLATE, posts=posts_list)
-    except Exception as e:
-        print(f"Error in index route: {e}")
-        # Если произошла ошибка, пытаемся инициализировать БД заново
-        init_db()
-        return redirect(url_for('index'))
+    # Для анонимов ключом служит только курсор, чтобы посторонние
+    # параметры запроса не размножали записи кэша
+    cache_key = ('index', request.args.get('before'))
+    use_page_cache = can_use_page_cache()
+    read_own_writes()
+    if use_page_cache:
+        entry = page_cache.get(cache_key)
+        if entry is not None:
+            if is_not_modified(entry['validators']):
+                return not_modified(entry['validators'])
+            g.page_cache_entry = entry
+            return with_validators(app.response_class(entry['body'], mimetype='text/html'),
+                                   entry['validators'])
+    
+    return with_db_retries(render_index, cache_key, use_page_cache)
+
+# Маркер в потоковом шаблоне: накопленный HTML отправляется клиенту.
+# Пользовательский текст экранируется, так что "<" в нем не встретится
+STREAM_FLUSH = '<!--flush-->'
+
+@app.template_global()
+def stream_flush():
+    return Markup(STREAM_FLUSH) if g.get('streaming') else ''
+
+def buffered_stream(pieces):
+    # Jinja отдает вывод мелкими кусками; склеиваем их до маркера,
+    # чтобы не отправлять и не сжимать каждый кусок отдельно
+    buffer = []
+    for piece in pieces:
+        if piece == STREAM_FLUSH:
+            yield ''.join(buffer)
+            buffer = []
+        else:
+            buffer.append(piece)
+    yield ''.join(buffer)
+
+def feed_chunks(conn, posts, viewer_id):
+    # Комментарии, лайки и фрагменты загружаются по мере отправки ленты
+    for start in range(0, len(posts), FEED_STREAM_CHUNK):
+        yield load_feed_posts(conn, posts[start:start + FEED_STREAM_CHUNK], viewer_id)
+
+def render_index(cache_key, use_page_cache):
+    conn = get_db()
+    validators = page_validators(conn, cache_key)
+    if is_not_modified(validators):
+        return not_modified(validators)
+    
+    cursor = parse_feed_cursor(request.args.get('before'))
+    posts, next_cursor = fetch_feed_page(conn, cursor, FEED_PAGE_SIZE)
+    context = {
+        'post_chunks': feed_chunks(conn, posts, session.get('user_id')),
+        'next_cursor': next_cursor,
+        'is_first_page': cursor is None,
+    }
+    
+    if not use_page_cache:
+        # Страница зрителя: шапка уходит сразу, посты - по мере рендеринга.
+        # Соединение остается в g, пока поток не закончится. Flash-сообщения
+        # забираем из сессии заранее: cookie сессии уходит до начала тела
+        get_flashed_messages(with_categories=True)
+        g.streaming = True
+        response = app.response_class(buffered_stream(stream_template('index.html', **context)),
+                                      mimetype='text/html')
+        return with_validators(response, validators)
+    
+    # Анонимам страница целиком кладется в кэш, поэтому рендерим ее сразу
+    html = render_template('index.html', **context)
+    g.page_cache_entry = {'body': html.encode(), 'validators': validators}
+    page_cache.set(cache_key, g.page_cache_entry)
+    return with_validators(html, validators)
+
+@app.route('/post/<int:post_id>/comments')
+def post_comments(post_id):
+    cursor = parse_feed_cursor(request.args.get('before'))
+    if cursor is None:
+        abort(400)
+    # Скрипт ленты просит только фрагмент, обычный переход - целую страницу
+    fragment = request.headers.get('X-Requested-With') == 'fetch'
+    read_own_writes()
+    
+    with get_db() as conn:
+        post = conn.execute('''
+            SELECT posts.*, users.username, users.display_name, users.is_admin 
+            FROM posts 
+            JOIN users ON posts.user_id = users.id 
+            WHERE posts.id = ? AND posts.visible = 1
+        ''', (post_id,)).fetchone()
+        if post is None:
+            abort(404)
+        
+        validators = page_validators(conn, 'post_comments', post_id, cursor, fragment)
+        if is_not_modified(validators):
+            response = not_modified(validators)
+        else:
+            comments, next_cursor = fetch_older_comments(conn, post_id, cursor, COMMENTS_PAGE_SIZE)
+            template = 'older_comments.html' if fragment else 'post_comments.html'
+            response = with_validators(render_template(template, post=post, post_id=post_id,
+                                                       comments=comments, next_cursor=next_cursor),
+                                       validators)
+    response.vary.add('X-Requested-With')
+    return response
 
 @app.route('/admin/users')
 def admin_users():
@@ -1594,12 +2217,36 @@ def admin_users():
         flash('Доступ запрещен', 'error')
         return redirect(url_for('index'))
     
+    status = request.args.get('status', 'all')
+    if status not in USER_STATUS_FILTERS:
+        status = 'all'
+    query = request.args.get('q', '').strip()
+    cursor = parse_cursor(request.args.get('before'))
+    
     with get_db() as conn:
-        users = conn.execute('''
-            SELECT * FROM users ORDER BY created_at DESC
-        ''').fetchall()
+        validators = page_validators(conn, 'admin_users', status, query, cursor)
+        if is_not_modified(validators):
+            return not_modified(validators)
+        
+        users, next_cursor = fetch_users_page(conn, status, query, cursor, ADMIN_PAGE_SIZE)
     
-    return render_template_string(ADMIN_USERS_TEMPLATE, users=users)
+    return with_validators(render_template('admin_users.html', users=users,
+                                           status=status, query=query,
+                                           next_cursor=next_cursor,
+                                           is_first_page=cursor is None), validators)
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    if not session.get('is_admin'):
+        abort(403)
+    
+    return {
+        'fragment_cache': post_fragment_cache.stats(),
+        'page_cache': page_cache.stats(),
+        'write_behind': write_behind.stats(),
+        'events': event_broker.stats(),
+        'db_errors': dict(db_error_counts),
+    }
 
 @app.route('/admin/ban/user/<int:user_id>', methods=['POST'])
 def ban_user(user_id):
@@ -1607,9 +2254,7 @@ def ban_user(user_id):
         flash('Доступ запрещен', 'error')
         return redirect(url_for('index'))
     
-    with get_db() as conn:
-        conn.execute('UPDATE users SET is_banned = 1 WHERE id = ?', (user_id,))
-        conn.commit()
+    set_users_banned([user_id], True)
     
     flash('Пользователь забанен', 'success')
     return redirect(url_for('admin_users'))
@@ -1620,9 +2265,7 @@ def unban_user(user_id):
         flash('Доступ запрещен', 'error')
         return redirect(url_for('index'))
     
-    with get_db() as conn:
-        conn.execute('UPDATE users SET is_banned = 0 WHERE id = ?', (user_id,))
-        conn.commit()
+    set_users_banned([user_id], False)
     
     flash('Пользователь разбанен', 'success')
     return redirect(url_for('admin_users'))
@@ -1633,13 +2276,132 @@ def ban_post(post_id):
         flash('Доступ запрещен', 'error')
         return redirect(url_for('index'))
     
-    with get_db() as conn:
-        conn.execute('UPDATE posts SET is_banned = 1 WHERE id = ?', (post_id,))
-        conn.commit()
+    set_posts_banned([post_id], True)
     
     flash('Пост забанен', 'success')
     return redirect(url_for('index'))
 
+def wants_json():
+    return request.is_json or request.accept_mimetypes.best == 'application/json'
+
+def bulk_params():
+    # Параметры принимаются и из JSON, и из обычной формы.
+    # В форме id можно передать несколькими полями или через запятую
+    # Некорректное тело запроса дает None
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return None
+        values = data.get('ids') or []
+        if not isinstance(values, list):
+            return None
+        return data.get('action'), [str(value) for value in values], data
+    values = []
+    for value in request.form.getlist('ids'):
+        values += value.replace(',', ' ').split()
+    return request.form.get('action'), values, request.form
+
+def parse_ids(values):
+    ids = [parse_int(value) for value in values]
+    if None in ids:
+        return None
+    # Сохраняем порядок, убираем повторы
+    return list(dict.fromkeys(ids))
+
+def parse_since(value):
+    # Время приходит из <input type="datetime-local"> и считается UTC,
+    # возвращаем его в миллисекундах, как в колонке ts
+    if not value:
+        return None
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return int(since.timestamp() * 1000)
+
+def bulk_result(affected, requested, message):
+    if wants_json():
+        return json_response({'affected': affected, 'requested': requested})
+    flash(f'{message}: {affected} из {requested}', 'success')
+    return redirect(url_for('admin_users'))
+
+def bulk_error(message):
+    if wants_json():
+        return json_response({'error': message}, 400)
+    flash(message, 'error')
+    return redirect(url_for('admin_users'))
+
+@app.route('/admin/bulk/users', methods=['POST'])
+def bulk_moderate_users():
+    if not session.get('is_admin'):
+        if wants_json():
+            return json_response({'error': 'Доступ запрещен'}, 403)
+        flash('Доступ запрещен', 'error')
+        return redirect(url_for('index'))
+    
+    params = bulk_params()
+    if params is None:
+        return bulk_error('Некорректный запрос')
+    action, values, _ = params
+    user_ids = parse_ids(values)
+    if action not in ('ban', 'unban'):
+        return bulk_error('Неизвестное действие')
+    if user_ids is None:
+        return bulk_error('Некорректный список пользователей')
+    if not user_ids:
+        return bulk_error('Не выбраны пользователи')
+    if len(user_ids) > BULK_MAX_IDS:
+        return bulk_error(f'Можно обработать не больше {BULK_MAX_IDS} пользователей за раз')
+    
+    affected = set_users_banned(user_ids, action == 'ban')
+    message = 'Забанено пользователей' if action == 'ban' else 'Разбанено пользователей'
+    return bulk_result(affected, len(user_ids), message)
+
+@app.route('/admin/bulk/posts', methods=['POST'])
+def bulk_moderate_posts():
+    if not session.get('is_admin'):
+        if wants_json():
+            return json_response({'error': 'Доступ запрещен'}, 403)
+        flash('Доступ запрещен', 'error')
+        return redirect(url_for('index'))
+    
+    params = bulk_params()
+    if params is None:
+        return bulk_error('Некорректный запрос')
+    action, values, params = params
+    if action not in ('ban', 'unban'):
+        return bulk_error('Неизвестное действие')
+    banned = action == 'ban'
+    
+    # Либо явный список постов, либо все посты пользователя с момента since
+    user_id = str(params.get('user_id') or '')
+    if user_id:
+        user_id = parse_int(user_id)
+        if user_id is None:
+            return bulk_error('Некорректный id пользователя')
+        try:
+            since = parse_since(params.get('since'))
+        except (TypeError, ValueError):
+            return bulk_error('Некорректная дата')
+        # Постов у пользователя может быть сколько угодно: каждая порция
+        # фиксируется своей транзакцией
+        affected = requested = 0
+        for post_ids in find_user_post_ids(get_db(), user_id, since):
+            affected += set_posts_banned(post_ids, banned)
+            requested += len(post_ids)
+    else:
+        post_ids = parse_ids(values)
+        if post_ids is None:
+            return bulk_error('Некорректный список постов')
+        if len(post_ids) > BULK_MAX_IDS:
+            return bulk_error(f'Можно обработать не больше {BULK_MAX_IDS} постов за раз')
+        requested = len(post_ids)
+        affected = set_posts_banned(post_ids, banned) if post_ids else 0
+    if not requested:
+        return bulk_error('Посты не найдены')
+    
+    message = 'Забанено постов' if banned else 'Разбанено постов'
+    return bulk_result(affected, requested, message)
+
 @app.route('/create_post', methods=['GET', 'POST'])
 def create_post():
     if not session.get('user_id'):
@@ -1653,16 +2415,16 @@ def create_post():
     if request.method == 'POST':
         content = request.form['content']
         
-        with get_db() as conn:
+        with write_transaction() as conn:
             conn.execute('''
-                INSERT INTO posts (user_id, content) VALUES (?, ?)
-            ''', (session['user_id'], content))
-            conn.commit()
+                INSERT INTO posts (user_id, content, ts) VALUES (?, ?, ?)
+            ''', (session['user_id'], content, now_ms()))
+        invalidate_page_cache()
         
         flash('Ваша история опубликована!', 'success')
         return redirect(url_for('index'))
     
-    return render_template_string(CREATE_POST_TEMPLATE)
+    return render_template('create_post.html')
 
 @app.route('/comment/<int:post_id>', methods=['POST'])
 def add_comment(post_id):
@@ -1676,13 +2438,13 @@ def add_comment(post_id):
     
     content = request.form['content']
     
-    with get_db() as conn:
-        conn.execute('''
-            INSERT INTO comments (post_id, user_id, content) VALUES (?, ?, ?)
-        ''', (post_id, session['user_id'], content))
-        conn.commit()
+    result = submit_write('comment', post_id, session['user_id'], content,
+                          wait=WRITE_BEHIND_DURABILITY == 'sync')
     
-    flash('Комментарий добавлен!', 'success')
+    if result is QUEUED:
+        flash('Комментарий отправлен!', 'success')
+    else:
+        flash('Комментарий добавлен!', 'success')
     return redirect(url_for('index'))
 
 @app.route('/like/<int:post_id>', methods=['POST'])
@@ -1695,25 +2457,425 @@ def like_post(post_id):
         flash('Ваш аккаунт забанен. Вы не можете ставить лайки', 'error')
         return redirect(url_for('index'))
     
+    result = submit_write('like', post_id, session['user_id'],
+                          wait=WRITE_BEHIND_DURABILITY == 'sync')
+    
+    if result is QUEUED:
+        flash('Лайк учтен!', 'success')
+    elif result is None:
+        flash('Пост не найден', 'error')
+    elif result[0]:
+        flash('Лайк поставлен!', 'success')
+    else:
+        flash('Лайк убран', 'success')
+    
+    return redirect(url_for('index'))
+
+@app.route('/api/v1/posts/<int:post_id>/like', methods=['POST'])
+def api_like_post(post_id):
+    if not session.get('user_id'):
+        return {'error': 'Пожалуйста, войдите чтобы ставить лайки'}, 401
+    
+    if session.get('user_banned'):
+        return {'error': 'Ваш аккаунт забанен. Вы не можете ставить лайки'}, 403
+    
+    # Ответу нужен новый счетчик, поэтому ждем фиксации в любом режиме
+    result = submit_write('like', post_id, session['user_id'])
+    
+    if result is None:
+        return {'error': 'Пост не найден'}, 404
+    
+    liked, count = result
+    return {'liked': liked, 'count': count}
+
+# Живая лента через Server-Sent Events. Один фоновый поток на процесс
+# опрашивает журнал events и раздает новые записи подписчикам; каждому
+# клиенту достается ограниченный буфер. Медленный клиент, переполнивший
+# буфер, получает событие reset и должен перезагрузить ленту
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+EVENTS_CLIENT_BUFFER = int(os.environ.get('EVENTS_CLIENT_BUFFER', 256))
+# Каждое подключение занимает поток воркера, пока открыта вкладка, поэтому
+# их число на процесс ограничено; сверх лимита отвечаем 503
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 8))
+EVENTS_RETRY_AFTER = int(os.environ.get('EVENTS_RETRY_AFTER', 30))
+
+class EventSubscriber:
+    def __init__(self):
+        self.events = deque()
+        self.overflowed = False
+        self.ready = threading.Event()
+    
+    def push(self, event):
+        if len(self.events) >= EVENTS_CLIENT_BUFFER:
+            self.overflowed = True
+        else:
+            self.events.append(event)
+        self.ready.set()
+    
+    def wait(self, timeout):
+        if not self.ready.wait(timeout):
+            return None
+        self.ready.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.last_id = None
+        self.rejected = 0
+    
+    def subscribe(self, conn):
+        subscriber = EventSubscriber()
+        with self._lock:
+            if len(self._subscribers) >= EVENTS_MAX_STREAMS:
+                self.rejected += 1
+                return None
+            # Без подписчиков поток журнал не читает и last_id отстает.
+            # Первому подписчику старые события не нужны (пропущенные он
+            # дочитает сам по Last-Event-ID), поэтому перематываем в конец
+            if not self._subscribers:
+                self.last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+            self._subscribers.add(subscriber)
+            # Поток запускается лениво, в том процессе, который обслуживает
+            # клиентов: после fork потоки родителя не наследуются
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='edirt-events', daemon=True)
+                self._thread.start()
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': len(self._subscribers),
+                'max_streams': EVENTS_MAX_STREAMS,
+                'rejected': self.rejected,
+            }
+    
+    def _run(self):
+        with app.app_context():
+            conn = get_db()
+            if self.last_id is None:
+                self.last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+            while True:
+                with self._lock:
+                    subscribers = list(self._subscribers)
+                    after_id = self.last_id
+                if subscribers:
+                    try:
+                        rows = fetch_events(conn, after_id, 500)
+                    except sqlite3.OperationalError as e:
+                        print(f"Error polling events: {e}")
+                        rows = []
+                    with self._lock:
+                        # Пока мы читали, все подписчики ушли и пришел новый,
+                        # который перемотал last_id: прочитанное уже не нужно
+                        if self.last_id != after_id:
+                            continue
+                        if rows:
+                            self.last_id = rows[-1][0]
+                    for row in rows:
+                        for subscriber in subscribers:
+                            subscriber.push(row)
+                    if len(rows) == 500:
+                        continue
+                time.sleep(EVENTS_POLL_INTERVAL)
+
+event_broker = EventBroker()
+
+def fetch_events(conn, after_id, limit):
+    return [tuple(row) for row in conn.execute('''
+        SELECT id, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?
+    ''', (after_id, limit))]
+
+def format_event(event):
+    event_id, event_type, data = event
+    return f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+
+@app.route('/events')
+def events():
+    subscriber = event_broker.subscribe(get_db())
+    if subscriber is None:
+        response = app.response_class('Слишком много подключений, попробуйте позже',
+                                      status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(EVENTS_RETRY_AFTER)
+        return response
+    
+    # Подписываемся до чтения пропущенных событий, чтобы ничего не потерять
+    # между ними; повторы отсекаются по id
+    backlog = []
+    reset = False
+    last_event_id = parse_int(request.headers.get('Last-Event-ID', request.args.get('last_event_id', '')))
     with get_db() as conn:
-        existing_like = conn.execute('''
-            SELECT id FROM likes WHERE post_id = ? AND user_id = ?
-        ''', (post_id, session['user_id'])).fetchone()
-        
-        if existing_like:
-            conn.execute('''
-                DELETE FROM likes WHERE post_id = ? AND user_id = ?
-            ''', (post_id, session['user_id']))
-            flash('Лайк убран', 'success')
+        if last_event_id is not None:
+            backlog = fetch_events(conn, last_event_id, EVENTS_CLIENT_BUFFER + 1)
+            if len(backlog) > EVENTS_CLIENT_BUFFER:
+                backlog, reset = [], True
+            last_sent = last_event_id
         else:
-            conn.execute('''
-                INSERT INTO likes (post_id, user_id) VALUES (?, ?)
-            ''', (post_id, session['user_id']))
-            flash('Лайк поставлен!', 'success')
-        
-        conn.commit()
+            last_sent = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
     
-    return redirect(url_for('index'))
+    def generate():
+        nonlocal last_sent
+        try:
+            # Браузер переподключится через 3 секунды и пришлет Last-Event-ID
+            yield 'retry: 3000\n\n'
+            if reset:
+                yield 'event: reset\ndata: {}\n\n'
+            pending = backlog
+            while True:
+                if subscriber.overflowed:
+                    yield 'event: reset\ndata: {}\n\n'
+                    return
+                for event in pending:
+                    if event[0] > last_sent:
+                        last_sent = event[0]
+                        yield format_event(event)
+                pending = subscriber.wait(EVENTS_HEARTBEAT)
+                if pending is None:
+                    pending = []
+                    yield ': heartbeat\n\n'
+        finally:
+            event_broker.unsubscribe(subscriber)
+    
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    # Если клиент ушел до первого байта, генератор не запускался
+    # и его finally не выполнится, место освобождаем при закрытии ответа
+    response.call_on_close(lambda: event_broker.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# JSON API только для чтения. Все списки отдаются страницами
+# с курсором next_cursor, размер страницы ограничен API_MAX_PAGE_SIZE
+API_POST_FIELDS = ('id', 'user_id', 'username', 'display_name', 'content',
+                   'created_at', 'ts', 'like_count', 'comment_count', 'liked')
+API_COMMENT_FIELDS = ('id', 'post_id', 'user_id', 'username', 'content', 'created_at', 'ts')
+API_USER_FIELDS = ('id', 'username', 'display_name', 'is_admin', 'is_banned', 'created_at',
+                   'post_count', 'comment_count')
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+@app.errorhandler(APIError)
+def handle_api_error(error):
+    return json_response({'error': error.message}, error.status)
+
+def json_response(payload, status=200):
+    # orjson заметно быстрее стандартного json, но он необязателен
+    if orjson is not None:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return app.response_class(body, status=status, mimetype='application/json')
+
+def api_page_size():
+    limit = request.args.get('limit', FEED_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise APIError('limit должен быть числом')
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
+
+def api_fields(allowed):
+    requested = request.args.get('fields')
+    if not requested:
+        return allowed
+    fields = tuple(field.strip() for field in requested.split(',') if field.strip())
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise APIError(f"Неизвестные поля: {', '.join(unknown)}")
+    return fields
+
+def api_cursor(name, parse=parse_feed_cursor):
+    value = request.args.get(name)
+    cursor = parse(value)
+    if value and cursor is None:
+        raise APIError(f'Некорректный курсор {name}')
+    return cursor
+
+@app.route('/api/v1/posts')
+def api_posts():
+    limit = api_page_size()
+    fields = api_fields(API_POST_FIELDS)
+    cursor = api_cursor('before')
+    read_own_writes()
+    
+    with get_db() as conn:
+        posts, next_cursor = fetch_feed_page(conn, cursor, limit)
+        liked_post_ids = set()
+        if 'liked' in fields:
+            liked_post_ids = load_liked_post_ids(conn, session.get('user_id'),
+                                                 [post['id'] for post in posts])
+    
+    items = []
+    for post in posts:
+        item = {field: post[field] for field in fields if field != 'liked'}
+        if 'liked' in fields:
+            item['liked'] = post['id'] in liked_post_ids
+        items.append(item)
+    return json_response({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/api/v1/posts/<int:post_id>/comments')
+def api_post_comments(post_id):
+    limit = api_page_size()
+    fields = api_fields(API_COMMENT_FIELDS)
+    cursor = api_cursor('after')
+    read_own_writes()
+    
+    with get_db() as conn:
+        post = conn.execute('''
+            SELECT id FROM posts WHERE id = ? AND visible = 1
+        ''', (post_id,)).fetchone()
+        if post is None:
+            raise APIError('Пост не найден', 404)
+        
+        # Комментарии идут от старых к новым, как в ленте
+        if cursor:
+            comments = conn.execute('''
+                SELECT comments.*, users.username 
+                FROM comments 
+                JOIN users ON comments.user_id = users.id 
+                WHERE comments.post_id = ? 
+                  AND (comments.ts, comments.id) > (?, ?)
+                ORDER BY comments.ts ASC, comments.id ASC
+                LIMIT ?
+            ''', (post_id, cursor[0], cursor[1], limit + 1)).fetchall()
+        else:
+            comments = conn.execute('''
+                SELECT comments.*, users.username 
+                FROM comments 
+                JOIN users ON comments.user_id = users.id 
+                WHERE comments.post_id = ? 
+                ORDER BY comments.ts ASC, comments.id ASC
+                LIMIT ?
+            ''', (post_id, limit + 1)).fetchall()
+    
+    next_cursor = None
+    if len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = make_feed_cursor(comments[-1])
+    
+    items = [{field: comment[field] for field in fields} for comment in comments]
+    return json_response({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/api/v1/users')
+def api_users():
+    if not session.get('is_admin'):
+        raise APIError('Доступ запрещен', 403)
+    
+    limit = api_page_size()
+    fields = api_fields(API_USER_FIELDS)
+    cursor = api_cursor('before', parse_cursor)
+    status = request.args.get('status', 'all')
+    if status not in USER_STATUS_FILTERS:
+        raise APIError(f"status должен быть одним из: {', '.join(USER_STATUS_FILTERS)}")
+    
+    with get_db() as conn:
+        users, next_cursor = fetch_users_page(conn, status, request.args.get('q', '').strip(),
+                                              cursor, limit)
+    
+    items = [{field: user[field] for field in fields} for user in users]
+    return json_response({'items': items, 'next_cursor': next_cursor})
+
+# Полнотекстовый поиск. Результаты упорядочены по BM25 (колонка rank
+# в FTS5, чем меньше, тем лучше), курсор имеет вид "<rank>,<id>"
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+# Маркеры подсветки в snippet(): управляющие символы не встречаются
+# в тексте постов, поэтому после экранирования их можно заменить на <mark>
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def build_match_query(text):
+    # Каждое слово ищется как фраза, последнее еще и как префикс, так что
+    # синтаксис запросов FTS5 из пользовательского ввода не интерпретируется
+    terms = text.split()
+    if not terms:
+        return None
+    quoted = ['"' + term.replace('"', '""') + '"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def highlight_snippet(snippet):
+    return Markup(str(escape(snippet)).replace(SNIPPET_START, '<mark>')
+                                      .replace(SNIPPET_END, '</mark>'))
+
+def parse_search_cursor(value):
+    cursor = parse_cursor(value)
+    if cursor is None:
+        return None
+    try:
+        return float(cursor[0]), cursor[1]
+    except ValueError:
+        return None
+
+def search_posts(conn, match, cursor, limit):
+    return conn.execute('''
+        SELECT posts.id, posts.ts, users.username, users.display_name,
+               snippet(posts_fts, 0, ?, ?, '…', 24) AS snippet,
+               posts_fts.rank AS rank
+        FROM posts_fts 
+        JOIN posts ON posts.id = posts_fts.rowid 
+        JOIN users ON posts.user_id = users.id 
+        WHERE posts_fts MATCH ? 
+          AND posts.visible = 1
+          AND (posts_fts.rank, posts_fts.rowid) > (?, ?)
+        ORDER BY posts_fts.rank, posts_fts.rowid
+        LIMIT ?
+    ''', (SNIPPET_START, SNIPPET_END, match, cursor[0], cursor[1], limit + 1)).fetchall()
+
+def search_comments(conn, match, cursor, limit):
+    return conn.execute('''
+        SELECT comments.id, comments.post_id, comments.ts,
+               users.username, users.display_name,
+               snippet(comments_fts, 0, ?, ?, '…', 24) AS snippet,
+               comments_fts.rank AS rank
+        FROM comments_fts 
+        JOIN comments ON comments.id = comments_fts.rowid 
+        JOIN users ON comments.user_id = users.id 
+        JOIN posts ON comments.post_id = posts.id 
+        WHERE comments_fts MATCH ? 
+          AND users.is_banned = 0 AND posts.visible = 1
+          AND (comments_fts.rank, comments_fts.rowid) > (?, ?)
+        ORDER BY comments_fts.rank, comments_fts.rowid
+        LIMIT ?
+    ''', (SNIPPET_START, SNIPPET_END, match, cursor[0], cursor[1], limit + 1)).fetchall()
+
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    search_type = 'comments' if request.args.get('type') == 'comments' else 'posts'
+    # Без курсора начинаем с наименьшего возможного ранга
+    cursor = parse_search_cursor(request.args.get('after')) or (float('-inf'), 0)
+    
+    results = []
+    next_cursor = None
+    match = build_match_query(query)
+    if match:
+        search_function = search_comments if search_type == 'comments' else search_posts
+        with get_db() as conn:
+            rows = search_function(conn, match, cursor, SEARCH_PAGE_SIZE)
+        if len(rows) > SEARCH_PAGE_SIZE:
+            rows = rows[:SEARCH_PAGE_SIZE]
+            next_cursor = f"{rows[-1]['rank']!r},{rows[-1]['id']}"
+        results = [dict(row, snippet=highlight_snippet(row['snippet'])) for row in rows]
+    
+    return render_template('search.html', query=query, search_type=search_type,
+                           results=results, next_cursor=next_cursor)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -1721,18 +2883,17 @@ def register():
         username = request.form['username']
         password = hash_password(request.form['password'])
         
-        with get_db() as conn:
-            try:
+        try:
+            with write_transaction() as conn:
                 conn.execute('''
                     INSERT INTO users (username, password) VALUES (?, ?)
                 ''', (username, password))
-                conn.commit()
-                flash('Регистрация успешна! Теперь вы можете войти', 'success')
-                return redirect(url_for('login'))
-            except sqlite3.IntegrityError:
-                flash('Имя пользователя уже занято', 'error')
+            flash('Регистрация успешна! Теперь вы можете войти', 'success')
+            return redirect(url_for('login'))
+        except sqlite3.IntegrityError:
+            flash('Имя пользователя уже занято', 'error')
     
-    return render_template_string(REGISTER_TEMPLATE)
+    return render_template('register.html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -1761,7 +2922,7 @@ def login():
             else:
                 flash('Неверное имя пользователя или пароль', 'error')
     
-    return render_template_string(LOGIN_TEMPLATE)
+    return render_template('login.html')
 
 @app.route('/logout')
 def logout():
@@ -1770,11 +2931,6 @@ def logout():
     return redirect(url_for('index'))
 
 # Инициализация базы данных при запуске
-if __name__ != '__main__':
-    # В продакшене инициализируем БД при запуске
-    init_db()
-    print("Edirt app started in production mode")
-
 if __name__ == '__main__':
     init_db()
     port = int(os.environ.get('PORT', 5000))
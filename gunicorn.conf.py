@@ -0,0 +1,49 @@
+# Конфигурация gunicorn для продакшена: gunicorn -c gunicorn.conf.py edirt:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Потоковые воркеры: запись в SQLite все равно сериализуется
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+request_threads = int(os.environ.get('GUNICORN_THREADS', max(4, multiprocessing.cpu_count() * 2)))
+# Каждое SSE-подключение (/events) держит поток, пока открыта вкладка.
+# edirt ограничивает их число на воркер (EVENTS_MAX_STREAMS), а потоков
+# заводим на столько больше, чтобы обычным запросам всегда хватало своих
+events_streams = int(os.environ.setdefault('EVENTS_MAX_STREAMS', str(request_threads)))
+threads = request_threads + events_streams
+
+# Приложение (шаблоны, статика) загружается один раз в мастере и
+# наследуется воркерами после fork. Пул соединений и фоновые потоки
+# в edirt привязаны к pid, так что в воркерах они создаются заново
+preload_app = True
+
+# Периодический перезапуск воркеров со случайным разбросом, чтобы они
+# не перезапускались все одновременно
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+accesslog = '-'
+errorlog = '-'
+
+def on_starting(server):
+    # Буфер отложенной записи у каждого воркера свой: в режиме async запрос
+    # после редиректа может попасть в другой воркер и не увидеть свою запись
+    if server.cfg.workers > 1 and os.environ.get('WRITE_BEHIND_DURABILITY') == 'async':
+        raise RuntimeError('WRITE_BEHIND_DURABILITY=async requires a single worker')
+    # Схема и начальные данные создаются один раз в мастере до запуска
+    # воркеров. Соединения мастера закрываем, чтобы они не попали в fork
+    from edirt import close_db, init_db
+    init_db()
+    close_db()
+
+def worker_exit(server, worker):
+    # Отложенные записи дописываем до выхода воркера, в том числе
+    # при плановом перезапуске по max_requests
+    from edirt import write_behind
+    write_behind.drain()
@@ -0,0 +1,76 @@
+// Лайки без перезагрузки страницы. Если запрос не удался,
+// форма отправляется обычным способом
+document.addEventListener('submit', function (event) {
+    var form = event.target;
+    if (!form.classList.contains('like-form') || !window.fetch) {
+        return;
+    }
+    event.preventDefault();
+
+    var button = form.querySelector('.like-btn');
+    button.disabled = true;
+    fetch(form.dataset.api, {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {'Accept': 'application/json'}
+    }).then(function (response) {
+        if (!response.ok) {
+            throw new Error('HTTP ' + response.status);
+        }
+        return response.json();
+    }).then(function (data) {
+        button.classList.toggle('liked', data.liked);
+        form.querySelector('.like-count').textContent = data.count;
+        button.disabled = false;
+    }).catch(function () {
+        form.submit();
+    });
+});
+
+// Живые обновления ленты: счетчики лайков и уведомление о новых историях
+if (window.EventSource && document.querySelector('.like-form, .empty-state')) {
+    var events = new EventSource('/events');
+
+    events.addEventListener('like_count', function (event) {
+        var data = JSON.parse(event.data);
+        var form = document.querySelector('.like-form[action="/like/' + data.post_id + '"]');
+        if (form) {
+            form.querySelector('.like-count').textContent = data.count;
+        }
+    });
+
+    // Сервер присылает reset, если клиент отстал и события были потеряны
+    ['post_created', 'reset'].forEach(function (type) {
+        events.addEventListener(type, function () {
+            var notice = document.querySelector('.new-posts-notice');
+            if (notice) {
+                notice.hidden = false;
+            }
+        });
+    });
+}
+
+// Более ранние комментарии подгружаются на место ссылки,
+// без скрипта ссылка открывает их отдельной страницей
+document.addEventListener('click', function (event) {
+    var link = event.target.closest && event.target.closest('.older-comments');
+    if (!link || !window.fetch) {
+        return;
+    }
+    event.preventDefault();
+
+    fetch(link.href, {
+        credentials: 'same-origin',
+        headers: {'X-Requested-With': 'fetch'}
+    }).then(function (response) {
+        if (!response.ok) {
+            throw new Error('HTTP ' + response.status);
+        }
+        return response.text();
+    }).then(function (html) {
+        link.insertAdjacentHTML('beforebegin', html);
+        link.parentNode.removeChild(link);
+    }).catch(function () {
+        window.location.href = link.href;
+    });
+});